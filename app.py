@@ -1,4 +1,4 @@
-from flask import Flask, request, jsonify, render_template, send_file
+from flask import Flask, Response, request, jsonify, render_template, send_file
 import openpyxl
 import os
 import uuid
@@ -6,26 +6,191 @@ import threading
 import re
 from werkzeug.utils import secure_filename
 from cairosvg import svg2pdf
-from PyPDF2 import PdfMerger
+from cairosvg.parser import Tree
+from cairosvg.surface import PDFSurface
+import cairocffi
+from PyPDF2 import PdfReader, PdfWriter
 import tempfile
-from collections import defaultdict
+import functools
+import logging
+import json
+import socket
+import sqlite3
+import time
+import io
+import math
+import shutil
+import zipfile
+import hashlib
+import pickle
+import multiprocessing
+from collections import defaultdict, deque
+from contextlib import closing, contextmanager
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
 
 app = Flask(__name__)
 
 # Configurações
 app.config['SECRET_KEY'] = os.environ.get('SECRET_KEY', 'dev-secret-key')
 app.config['MAX_WORKERS'] = int(os.environ.get('MAX_WORKERS', 3))
+# Processos para o trabalho de CPU fora do processo web (leitura do Excel, validação, montagem dos PDFs)
+app.config['CPU_WORKERS'] = int(os.environ.get('CPU_WORKERS', 2))
+# Conexões SSE simultâneas por processo; cada uma ocupa uma thread do gunicorn até o job terminar
+app.config['SSE_MAX_CONEXOES'] = int(os.environ.get('SSE_MAX_CONEXOES', 4))
 app.config['MAX_CONTENT_LENGTH'] = int(os.environ.get('MAX_CONTENT_LENGTH', 16 * 1024 * 1024))  # 16MB
+# Limite do arquivo no upload em partes (cada parte continua limitada por MAX_CONTENT_LENGTH)
+app.config['UPLOAD_MAX_BYTES'] = int(os.environ.get('UPLOAD_MAX_BYTES', 200 * 1024 * 1024))  # 200MB
+# Cartas renderizadas por lote numa única superfície PDF (fontes embutidas uma vez por lote)
+app.config['CARTAS_POR_LOTE'] = int(os.environ.get('CARTAS_POR_LOTE', 200))
+# Padrão do modo de empacotamento (cartas com até 12/24 números); cada pedido pode escolher com "empacotar"
+app.config['EMPACOTAR_CARTAS'] = os.environ.get('EMPACOTAR_CARTAS', '0').lower() in ('1', 'true', 'sim')
+# Acima deste total em memória, os PDFs das cartas vão para arquivos temporários (0 = nunca)
+app.config['PDF_SPILL_BYTES'] = int(os.environ.get('PDF_SPILL_BYTES', 128 * 1024 * 1024))  # 128MB
+app.config['EXCEL_CACHE_MAX_BYTES'] = int(os.environ.get('EXCEL_CACHE_MAX_BYTES', 256 * 1024 * 1024))  # 256MB
+# Cache de cartas renderizadas (0 = desativado). Opcional: separa cada lote em PDFs de uma
+# página (CPU extra em todo job) e as cartas do cache não compartilham as fontes embutidas,
+# então só compensa quando as mesmas cartas são geradas de novo com frequência
+app.config['RENDER_CACHE_MAX_BYTES'] = int(os.environ.get('RENDER_CACHE_MAX_BYTES', 0))
+# Fila de jobs persistente (compartilhada entre workers do gunicorn)
+app.config['JOBS_DB'] = os.environ.get('JOBS_DB', 'jobs.db')
+app.config['MAX_JOBS_SIMULTANEOS'] = int(os.environ.get('MAX_JOBS_SIMULTANEOS', 1))
+app.config['FILA_MAX'] = int(os.environ.get('FILA_MAX', 20))
+app.config['JOB_HEARTBEAT_TIMEOUT'] = int(os.environ.get('JOB_HEARTBEAT_TIMEOUT', 60))  # segundos
+# Limpeza automática de uploads/ e temp/ (TTLs em segundos; 0 = nunca expira)
+app.config['OUTPUT_TTL'] = int(os.environ.get('OUTPUT_TTL', 24 * 3600))
+app.config['UPLOAD_TTL'] = int(os.environ.get('UPLOAD_TTL', 24 * 3600))
+app.config['JOBS_TTL'] = int(os.environ.get('JOBS_TTL', 7 * 24 * 3600))
+app.config['TEMP_MAX_BYTES'] = int(os.environ.get('TEMP_MAX_BYTES', 2 * 1024 * 1024 * 1024))  # 2GB; 0 = sem cota
+app.config['LIMPEZA_INTERVALO'] = int(os.environ.get('LIMPEZA_INTERVALO', 300))  # segundos
 
 # Pastas
 UPLOAD_FOLDER = 'uploads'
 TEMPLATE_FOLDER = 'templates'
 TEMP_FOLDER = 'temp'
+CACHE_FOLDER = 'cache'
 
-for folder in [UPLOAD_FOLDER, TEMPLATE_FOLDER, TEMP_FOLDER]:
+for folder in [UPLOAD_FOLDER, TEMPLATE_FOLDER, TEMP_FOLDER, CACHE_FOLDER]:
     os.makedirs(folder, exist_ok=True)
 
-# Jobs em andamento
+# Logging
+class _FiltroJobId(logging.Filter):
+    """Garante o campo job_id nos registros que não vêm de um logger de job"""
+
+    def filter(self, record):
+        if not hasattr(record, 'job_id'):
+            record.job_id = '-'
+        return True
+
+logger = logging.getLogger('cartas')
+if not logger.handlers:
+    _handler = logging.StreamHandler()
+    _handler.setFormatter(logging.Formatter('%(asctime)s %(levelname)s [%(process)d] [job %(job_id)s] %(message)s'))
+    _handler.addFilter(_FiltroJobId())
+    logger.addHandler(_handler)
+    logger.setLevel(os.environ.get('LOG_LEVEL', 'INFO').upper())
+    logger.propagate = False
+
+def logger_job(job_id):
+    """Logger que inclui o job_id em cada mensagem"""
+    return logging.LoggerAdapter(logger, {'job_id': job_id})
+
+# Métricas no formato de exposição do Prometheus (por processo), servidas em /metrics
+BUCKETS_SEGUNDOS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600, 1800)
+
+DESCRICAO_METRICAS = {
+    'cartas_renderizadas_total': ('counter', 'Cartas renderizadas com sucesso'),
+    'cartas_com_erro_total': ('counter', 'Cartas que falharam na renderização'),
+    'cartas_pdf_saida_bytes_total': ('counter', 'Bytes de PDF final gerados'),
+    'cartas_cache_acertos_total': ('counter', 'Cartas reaproveitadas do cache de renderização'),
+    'cartas_jobs_finalizados_total': ('counter', 'Jobs finalizados por status'),
+    'cartas_uploads_total': ('counter', 'Arquivos Excel recebidos'),
+    'cartas_uploads_bytes_total': ('counter', 'Bytes de arquivos Excel recebidos'),
+    'cartas_requisicoes_total': ('counter', 'Requisições instrumentadas por endpoint e código HTTP'),
+    'cartas_carta_renderizacao_segundos': ('histogram', 'Tempo de renderização de uma carta'),
+    'cartas_etapa_duracao_segundos': ('histogram', 'Duração de cada etapa do job'),
+    'cartas_job_duracao_segundos': ('histogram', 'Duração total dos jobs'),
+    'cartas_requisicao_duracao_segundos': ('histogram', 'Duração das requisições instrumentadas'),
+    'cartas_jobs': ('gauge', 'Jobs no dicionário jobs deste processo, por status'),
+    'cartas_fila_jobs': ('gauge', 'Jobs na fila persistente, por status'),
+    'cartas_pasta_bytes': ('gauge', 'Bytes ocupados por pasta'),
+    'cartas_sse_conexoes': ('gauge', 'Conexões abertas em /api/job-events deste processo'),
+    'cartas_limpeza_removidos_total': ('counter', 'Arquivos e pastas removidos pela limpeza automática, por motivo'),
+    'cartas_limpeza_bytes_total': ('counter', 'Bytes liberados pela limpeza automática, por motivo'),
+}
+
+def _formatar_labels(labels):
+    if not labels:
+        return ''
+    return '{' + ','.join(f'{nome}="{str(valor)}"' for nome, valor in labels) + '}'
+
+class Metricas:
+    """Contadores e histogramas em memória, protegidos por lock"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.contadores = defaultdict(float)  # (nome, labels) -> valor
+        self.histogramas = {}  # (nome, labels) -> [contagens por bucket, soma, quantidade]
+
+    def incrementar(self, nome, valor=1, **labels):
+        with self._lock:
+            self.contadores[(nome, tuple(sorted(labels.items())))] += valor
+
+    def observar(self, nome, valor, **labels):
+        chave = (nome, tuple(sorted(labels.items())))
+        with self._lock:
+            histograma = self.histogramas.get(chave)
+            if histograma is None:
+                histograma = self.histogramas[chave] = [[0] * len(BUCKETS_SEGUNDOS), 0.0, 0]
+            for i, limite in enumerate(BUCKETS_SEGUNDOS):
+                if valor <= limite:
+                    histograma[0][i] += 1
+            histograma[1] += valor
+            histograma[2] += 1
+
+    def exportar(self, gauges):
+        """Texto no formato de exposição do Prometheus; gauges: {(nome, labels): valor}"""
+        with self._lock:
+            series = defaultdict(list)
+            for (nome, labels), valor in self.contadores.items():
+                series[nome].append(f'{nome}{_formatar_labels(labels)} {valor:g}')
+            for (nome, labels), (contagens, soma, quantidade) in self.histogramas.items():
+                for limite, contagem in zip(BUCKETS_SEGUNDOS, contagens):
+                    series[nome].append(f'{nome}_bucket{_formatar_labels(labels + (("le", f"{limite:g}"),))} {contagem}')
+                series[nome].append(f'{nome}_bucket{_formatar_labels(labels + (("le", "+Inf"),))} {quantidade}')
+                series[nome].append(f'{nome}_sum{_formatar_labels(labels)} {soma:g}')
+                series[nome].append(f'{nome}_count{_formatar_labels(labels)} {quantidade}')
+        for (nome, labels), valor in gauges.items():
+            series[nome].append(f'{nome}{_formatar_labels(labels)} {valor:g}')
+        
+        linhas = []
+        for nome in sorted(series):
+            tipo, descricao = DESCRICAO_METRICAS.get(nome, ('untyped', nome))
+            linhas.append(f'# HELP {nome} {descricao}')
+            linhas.append(f'# TYPE {nome} {tipo}')
+            linhas.extend(series[nome])
+        return '\n'.join(linhas) + '\n'
+
+metricas = Metricas()
+
+def medir_requisicao(endpoint):
+    """Decorador que registra duração e código HTTP das requisições de um endpoint"""
+    def decorador(funcao):
+        @functools.wraps(funcao)
+        def wrapper(*args, **kwargs):
+            inicio = time.perf_counter()
+            status = 500
+            try:
+                resposta = funcao(*args, **kwargs)
+                status = resposta[1] if isinstance(resposta, tuple) else getattr(resposta, 'status_code', 200)
+                return resposta
+            finally:
+                metricas.observar('cartas_requisicao_duracao_segundos', time.perf_counter() - inicio, endpoint=endpoint)
+                metricas.incrementar('cartas_requisicoes_total', endpoint=endpoint, status=status)
+        return wrapper
+    return decorador
+
+# Jobs em andamento neste processo (o estado persistente fica em JOBS_DB)
 jobs = {}
 
 def selecionar_template(quantidade_numeros):
@@ -37,34 +202,28 @@ def selecionar_template(quantidade_numeros):
     elif quantidade_numeros <= 6:
         return f"carta_{quantidade_numeros}_numeros.svg"
     else:
-        # Para mais de 6 números, usar template de 6
+        # Modo de empacotamento: menor template ampliado em que o grupo cabe;
+        # sem nenhum, usar template de 6
+        for capacidade in capacidades_templates():
+            if capacidade >= quantidade_numeros:
+                return f"carta_{capacidade}_numeros.svg"
         return "carta_6_numeros.svg"
 
 def agrupar_por_cliente(data, coluna_cliente):
     """
-    Agrupa os dados por cliente mantendo a ordem original das linhas do Excel
+    Agrupa os dados por cliente mantendo a ordem original das linhas do Excel.
+    Aceita qualquer iterável de linhas (inclusive o gerador de linhas_de_colunas)
+    e percorre os dados uma única vez.
     """
-    clientes = defaultdict(list)
-    
-    for row in data:
-        cliente = row.get(coluna_cliente, 'Cliente Desconhecido')
-        clientes[cliente].append(row)
-    
-    # Manter a ordem original das linhas do Excel
-    # Criar lista ordenada baseada na primeira aparição de cada cliente
-    ordem_clientes = []
-    clientes_vistos = set()
+    # dict mantém a ordem de inserção, ou seja, a primeira aparição de cada cliente
+    clientes_ordenados = {}
     
     for row in data:
         cliente = row.get(coluna_cliente, 'Cliente Desconhecido')
-        if cliente not in clientes_vistos:
-            ordem_clientes.append(cliente)
-            clientes_vistos.add(cliente)
-    
-    # Criar dicionário ordenado baseado na ordem original
-    clientes_ordenados = {}
-    for cliente in ordem_clientes:
-        clientes_ordenados[cliente] = clientes[cliente]
+        registros = clientes_ordenados.get(cliente)
+        if registros is None:
+            registros = clientes_ordenados[cliente] = []
+        registros.append(row)
     
     return clientes_ordenados
 
@@ -77,65 +236,532 @@ def dividir_numeros_por_carta(numeros, max_por_carta=6):
         grupos.append(numeros[i:i + max_por_carta])
     return grupos
 
+def _headers_excel(primeira_linha):
+    """
+    Cabeçalhos não vazios da primeira linha, como (posição, nome). Nomes repetidos
+    ganham um sufixo (" (2)", " (3)"...) para que cada coluna continue separada.
+    """
+    headers = []
+    vistos = set()
+    for posicao, valor in enumerate(primeira_linha):
+        if not valor:
+            continue
+        nome = base = str(valor)
+        sufixo = 2
+        while nome in vistos:
+            nome = f'{base} ({sufixo})'
+            sufixo += 1
+        vistos.add(nome)
+        headers.append((posicao, nome))
+    return headers
+
+def abrir_excel_streaming(filepath, numerar=False):
+    """
+    Abre o Excel em modo read_only e retorna (headers, gerador de linhas).
+    As linhas são lidas sob demanda; o arquivo é fechado ao final do gerador.
+    Com numerar, gera (número da linha no Excel, linha), já que as vazias são puladas.
+    """
+    workbook = openpyxl.load_workbook(filepath, read_only=True)
+    try:
+        sheet = workbook.active
+        linhas = sheet.iter_rows(values_only=True)
+        posicoes = _headers_excel(next(linhas, ()))
+    except Exception:
+        workbook.close()
+        raise
+    headers = [nome for _, nome in posicoes]
+    
+    def gerar_linhas():
+        try:
+            for numero_linha, valores in enumerate(linhas, 2):
+                quantidade = len(valores)
+                row_data = {nome: valores[posicao] if posicao < quantidade else None
+                            for posicao, nome in posicoes}
+                if any(row_data.values()):  # Só devolver se a linha não estiver vazia
+                    yield (numero_linha, row_data) if numerar else row_data
+        finally:
+            workbook.close()
+    
+    return headers, gerar_linhas()
+
+def ler_cabecalho_e_dimensao(filepath):
+    """
+    Lê apenas a linha de cabeçalhos do Excel e estima a quantidade de linhas pela
+    dimensão gravada na planilha (max_row do modo read_only), sem percorrer as linhas.
+    A estimativa inclui linhas vazias; None se a planilha não grava a dimensão.
+    """
+    workbook = openpyxl.load_workbook(filepath, read_only=True)
+    try:
+        sheet = workbook.active
+        posicoes = _headers_excel(next(sheet.iter_rows(values_only=True), ()))
+        total_linhas = sheet.max_row - 1 if sheet.max_row and sheet.max_row > 1 else None
+    finally:
+        workbook.close()
+    return [nome for _, nome in posicoes], total_linhas
+
 def read_excel_with_openpyxl(filepath):
     """Lê arquivo Excel usando openpyxl em vez de pandas"""
-    workbook = openpyxl.load_workbook(filepath)
-    sheet = workbook.active
+    headers, linhas = abrir_excel_streaming(filepath)
+    return headers, list(linhas)
+
+# Pool de CPU: leitura do Excel com openpyxl e validação são Python puro e seguram o GIL;
+# no processo web, disputariam com /health e /api/job-status. Rodam num pool de processos
+# próprio (separado do de renderização, para não esperar na fila de um job grande).
+_executor_cpu = None
+_executor_cpu_lock = threading.Lock()
+
+def executar_no_pool_cpu(funcao, *args):
+    """
+    Executa funcao(*args) no pool de CPU e devolve o resultado; a thread do request
+    só espera. Nos processos dos pools, executa direto.
+    """
+    global _executor_cpu
+    if multiprocessing.parent_process() is not None:
+        return funcao(*args)
     
-    # Obter cabeçalhos (primeira linha)
-    headers = []
-    for cell in sheet[1]:
-        if cell.value:
-            headers.append(str(cell.value))
-    
-    # Obter dados
-    data = []
-    for row in sheet.iter_rows(min_row=2):
-        row_data = {}
-        for i, cell in enumerate(row):
-            if i < len(headers):
-                row_data[headers[i]] = cell.value
-        if any(row_data.values()):  # Só adicionar se a linha não estiver vazia
-            data.append(row_data)
-    
-    return headers, data
+    with _executor_cpu_lock:
+        if _executor_cpu is None:
+            _executor_cpu = ProcessPoolExecutor(
+                max_workers=app.config['CPU_WORKERS'],
+                mp_context=multiprocessing.get_context('spawn')
+            )
+        executor = _executor_cpu
+    try:
+        return executor.submit(funcao, *args).result()
+    except BrokenProcessPool:
+        with _executor_cpu_lock:
+            if _executor_cpu is executor:
+                _executor_cpu = None
+        raise
+
+# Hash SHA-256 dos uploads: caminho -> ((tamanho, mtime), hash)
+_hashes_arquivos = {}
+
+def hash_arquivo(filepath):
+    """SHA-256 do conteúdo do arquivo, memorizado enquanto o arquivo não mudar"""
+    stat = os.stat(filepath)
+    assinatura = (stat.st_size, stat.st_mtime_ns)
+    entrada = _hashes_arquivos.get(filepath)
+    if entrada is None or entrada[0] != assinatura:
+        sha = hashlib.sha256()
+        with open(filepath, 'rb') as f:
+            for bloco in iter(lambda: f.read(1024 * 1024), b''):
+                sha.update(bloco)
+        entrada = (assinatura, sha.hexdigest())
+        _hashes_arquivos[filepath] = entrada
+    return entrada[1]
+
+# Versão do formato do cache colunar; entradas de versões antigas são ignoradas e saem pelo LRU
+VERSAO_CACHE_PLANILHA = 3
+
+def _caminho_cache_planilha(sha):
+    return os.path.join(CACHE_FOLDER, f'planilha_{sha}_v{VERSAO_CACHE_PLANILHA}.pkl')
+
+def limitar_cache(prefixo, max_bytes, preservar=None):
+    """
+    Remove as entradas de CACHE_FOLDER com o prefixo dado, das usadas há mais tempo
+    (mtime) para as mais recentes, até o total caber em max_bytes
+    """
+    entradas = []
+    for nome in os.listdir(CACHE_FOLDER):
+        if nome.startswith(prefixo) and not nome.endswith('.tmp'):
+            caminho = os.path.join(CACHE_FOLDER, nome)
+            try:
+                stat = os.stat(caminho)
+            except FileNotFoundError:
+                continue
+            entradas.append((stat.st_mtime, stat.st_size, caminho))
+    
+    total = sum(tamanho for _, tamanho, _ in entradas)
+    for _, tamanho, caminho in sorted(entradas):
+        if total <= max_bytes:
+            break
+        if caminho == preservar:
+            continue
+        try:
+            os.remove(caminho)
+        except FileNotFoundError:
+            pass
+        total -= tamanho
+
+def _gravar_cache_planilha(sha, headers, colunas, total_linhas, numeros_linhas):
+    """
+    Grava a planilha em formato colunar: um pickle com os metadados, incluindo a
+    posição de cada coluna no arquivo, seguido de um pickle por coluna e de um com
+    o número no Excel de cada linha
+    """
+    blocos = []
+    
+    def adicionar_bloco(valores):
+        bloco = pickle.dumps(valores, pickle.HIGHEST_PROTOCOL)
+        posicao = (sum(len(b) for b in blocos), len(bloco))
+        blocos.append(bloco)
+        return posicao
+    
+    posicoes = {header: adicionar_bloco(colunas[header]) for header in headers}
+    posicao_linhas = adicionar_bloco(numeros_linhas)
+    
+    caminho = _caminho_cache_planilha(sha)
+    temporario = f'{caminho}.{uuid.uuid4().hex}.tmp'
+    with open(temporario, 'wb') as f:
+        pickle.dump({'headers': headers, 'total_linhas': total_linhas, 'colunas': posicoes,
+                     'numeros_linhas': posicao_linhas},
+                    f, pickle.HIGHEST_PROTOCOL)
+        for bloco in blocos:
+            f.write(bloco)
+    os.replace(temporario, caminho)
+    limitar_cache('planilha_', app.config['EXCEL_CACHE_MAX_BYTES'], preservar=caminho)
+
+def montar_cache_planilha(filepath, sha):
+    """Lê o Excel com openpyxl e grava o cache colunar (no pool de CPU)"""
+    if os.path.exists(_caminho_cache_planilha(sha)):
+        return  # montado por outro request enquanto este esperava no pool
+    headers, linhas = abrir_excel_streaming(filepath, numerar=True)
+    colunas = {header: [] for header in headers}
+    numeros_linhas = []
+    for numero_linha, row_data in linhas:
+        for header in headers:
+            colunas[header].append(row_data.get(header))
+        numeros_linhas.append(numero_linha)
+    _gravar_cache_planilha(sha, headers, colunas, len(numeros_linhas), numeros_linhas)
+
+def _abrir_cache_planilha(filepath):
+    """
+    Abre a entrada de cache da planilha, lendo o Excel com openpyxl apenas na
+    primeira vez que um conteúdo é visto. Retorna o arquivo posicionado nas colunas
+    e os metadados.
+    """
+    sha = hash_arquivo(filepath)
+    caminho = _caminho_cache_planilha(sha)
+    try:
+        f = open(caminho, 'rb')
+    except FileNotFoundError:
+        executar_no_pool_cpu(montar_cache_planilha, filepath, sha)
+        f = open(caminho, 'rb')
+    
+    # Marcar como usada recentemente (LRU pelo mtime)
+    try:
+        os.utime(caminho)
+    except FileNotFoundError:
+        pass
+    
+    meta = pickle.load(f)
+    return f, meta
+
+def carregar_planilha(filepath):
+    """Garante a planilha no cache e retorna (headers, quantidade de linhas)"""
+    f, meta = _abrir_cache_planilha(filepath)
+    f.close()
+    return meta['headers'], meta['total_linhas']
+
+def ler_cabecalhos_planilha(filepath):
+    """
+    Retorna (headers, quantidade de linhas) lendo só os metadados do cache. Se a
+    planilha ainda não está no cache, lê apenas o cabeçalho do Excel e a quantidade
+    vem da dimensão da planilha (ler_cabecalho_e_dimensao): aproximada, ou None.
+    """
+    try:
+        with open(_caminho_cache_planilha(hash_arquivo(filepath)), 'rb') as f:
+            meta = pickle.load(f)
+        return meta['headers'], meta['total_linhas']
+    except FileNotFoundError:
+        # Mesmo só o cabeçalho carrega a tabela de strings compartilhadas do xlsx
+        return executar_no_pool_cpu(ler_cabecalho_e_dimensao, filepath)
+
+def ler_colunas_planilha(filepath, colunas=None, numeros_linhas=False):
+    """
+    Retorna (headers, {coluna: valores}) a partir do cache, opcionalmente só de algumas
+    colunas. Só as colunas pedidas são lidas do disco e desserializadas. Com
+    numeros_linhas, retorna também o número no Excel de cada linha.
+    """
+    f, meta = _abrir_cache_planilha(filepath)
+    valores = {}
+    with f:
+        inicio = f.tell()
+        for coluna in meta['headers'] if colunas is None else colunas:
+            posicao = meta['colunas'].get(coluna)
+            if posicao is None or coluna in valores:
+                continue
+            f.seek(inicio + posicao[0])
+            valores[coluna] = pickle.loads(f.read(posicao[1]))
+        if numeros_linhas:
+            f.seek(inicio + meta['numeros_linhas'][0])
+            return meta['headers'], valores, pickle.loads(f.read(meta['numeros_linhas'][1]))
+    return meta['headers'], valores
+
+def linhas_de_colunas(valores):
+    """Gera as linhas como dicts a partir de {coluna: valores}"""
+    nomes = list(valores)
+    for linha in zip(*valores.values()):
+        yield dict(zip(nomes, linha))
+
+# Formatos de placeholder aceitos nos templates, na ordem em que são procurados
+FORMATOS_PLACEHOLDER = [
+    ('{{', '}}'),  # {{coluna}}
+    ('[', ']'),    # [coluna]
+    ('{', '}'),    # {coluna}
+    ('%', '%'),    # %coluna%
+    ('$', '$'),    # $coluna$
+    ('#', '#'),    # #coluna#
+]
+
+# Campos usados pelos templates carta_*.svg
+CAMPOS_CARTA = ('CLIENTE', 'NUMERO', 'ICCID')
+
+class TemplateCompilado:
+    """
+    Template SVG pré-processado numa lista de trechos literais e slots numerados.
+    Renderizar uma carta é apenas preencher os slots e fazer um único join.
+    """
+
+    def __init__(self, partes, slots, hash_origem):
+        # partes: trechos literais; as posições dos slots ficam com ''
+        # slots: lista de (posicao, campo, ordem) - ordem é a ocorrência do campo no template
+        # hash_origem: SHA-256 do SVG de origem (identifica a versão do template)
+        self.partes = partes
+        self.slots = slots
+        self.hash_origem = hash_origem
+
+    def contar(self, campo):
+        """Quantidade de slots de um campo no template"""
+        return sum(1 for _, nome, _ in self.slots if nome == campo)
+
+    def render(self, valores):
+        """
+        Preenche os slots. Um valor str é usado em todas as ocorrências do campo;
+        uma lista preenche as ocorrências em sequência e as restantes ficam vazias.
+        """
+        partes = list(self.partes)
+        for posicao, campo, ordem in self.slots:
+            valor = valores.get(campo, '')
+            if isinstance(valor, (list, tuple)):
+                valor = valor[ordem] if ordem < len(valor) else ''
+            partes[posicao] = valor
+        return ''.join(partes)
+
+def compilar_template(svg_content, campos, tags_texto=False):
+    """
+    Percorre o SVG uma única vez e separa trechos literais dos placeholders
+    de cada campo (todos os formatos de FORMATOS_PLACEHOLDER). Com tags_texto,
+    elementos <tspan>/<text> cujo conteúdo é apenas o nome do campo também viram slots.
+    """
+    alternativas = []
+    grupos = []  # (campo, abertura, fechamento) por grupo do regex
+    for campo in campos:
+        for prefixo, sufixo in FORMATOS_PLACEHOLDER:
+            alternativas.append(f'({re.escape(prefixo + campo + sufixo)})')
+            grupos.append((campo, '', ''))
+    if tags_texto:
+        for campo in campos:
+            for tag in ('tspan', 'text'):
+                alternativas.append(rf'(<{tag}[^>]*>\s*{re.escape(campo)}\s*</{tag}>)')
+                grupos.append((campo, f'<{tag}>', f'</{tag}>'))
+
+    partes = []
+    slots = []
+    ocorrencias = defaultdict(int)
+    inicio = 0
+    if alternativas:
+        for match in re.finditer('|'.join(alternativas), svg_content):
+            campo, abertura, fechamento = grupos[match.lastindex - 1]
+            partes.append(svg_content[inicio:match.start()] + abertura)
+            slots.append((len(partes), campo, ocorrencias[campo]))
+            partes.append('')
+            ocorrencias[campo] += 1
+            inicio = match.end()
+            if fechamento:
+                partes.append(fechamento)
+    partes.append(svg_content[inicio:])
+
+    return TemplateCompilado(partes, slots, hashlib.sha256(svg_content.encode('utf-8')).hexdigest())
+
+# Templates compilados: (caminho, campos) -> (mtime, TemplateCompilado)
+templates_compilados = {}
+
+def carregar_template(template_file, campos=CAMPOS_CARTA):
+    """
+    Retorna o template compilado, recompilando apenas se o arquivo mudou no disco.
+    Retorna None se o template não existir.
+    """
+    template_path = os.path.join(TEMPLATE_FOLDER, template_file)
+    try:
+        mtime = os.stat(template_path).st_mtime_ns
+    except FileNotFoundError:
+        return None
+
+    chave = (template_path, tuple(campos))
+    entrada = templates_compilados.get(chave)
+    if entrada is None or entrada[0] != mtime:
+        with open(template_path, 'r', encoding='utf-8') as f:
+            svg_content = f.read()
+        entrada = (mtime, compilar_template(svg_content, campos))
+        templates_compilados[chave] = entrada
+    return entrada[1]
+
+# Templates de alta capacidade, gerados a partir do layout de 6 linhas
+TEMPLATE_BASE_AMPLIADO = 'carta_6_numeros.svg'
+CAPACIDADES_AMPLIADAS = (12, 24)
+LINHAS_POR_COLUNA = 12
+PASSO_LINHA_AMPLIADO = 12  # o layout de 6 linhas usa 16
+COLUNAS_TABELA = {1: ((100, 250, 400),), 2: ((60, 135, 245), (255, 330, 440))}  # (x número, x ICCID, fim da linha)
+_PADRAO_TEMPLATE_CARTA = re.compile(r'^carta_(\d+)_numeros?\.svg$')
+_PADRAO_TEXTO_SVG = re.compile(r'<text x="[\d.]+" y="[\d.]+" (style="[^"]*")>\s*(.*?)\s*</text>', re.S)
+_PADRAO_LINHA_SVG = re.compile(r'<line [^>]*?(style="[^"]*")/>')
+
+def _coordenada(valor):
+    return f'{round(valor, 1):g}'
+
+def gerar_template_ampliado(svg_base, capacidade):
+    """
+    Monta um template de `capacidade` números a partir do layout de 6 linhas:
+    mantém o texto acima e abaixo da tabela (este deslocado para baixo) e refaz
+    a tabela com passo menor, em duas colunas quando não cabe numa só.
+    Os placeholders seguem a ordem do documento, coluna a coluna.
+    """
+    colunas = math.ceil(capacidade / LINHAS_POR_COLUNA)
+    if colunas not in COLUNAS_TABELA:
+        raise ValueError(f'Capacidade {capacidade} não cabe na página')
+    linhas = math.ceil(capacidade / colunas)
+    
+    inicio_tabela = svg_base.index('<!-- Tabela -->')
+    inicio_tabela = svg_base.rindex('\n', 0, inicio_tabela) + 1
+    fim_tabela = svg_base.index('<!-- Texto de contato -->')
+    fim_tabela = svg_base.rindex('\n', 0, fim_tabela) + 1
+    tabela = svg_base[inicio_tabela:fim_tabela]
+    
+    textos = _PADRAO_TEXTO_SVG.findall(tabela)
+    linhas_svg = [float(y) for y in re.findall(r'y1="([\d.]+)"', tabela)]
+    (estilo_cabecalho, rotulo_numero), (_, rotulo_iccid), (estilo_texto, campo_numero), (_, campo_iccid) = textos[:4]
+    estilo_linha = _PADRAO_LINHA_SVG.search(tabela).group(1)
+    y_cabecalho = float(re.search(r'<text x="[\d.]+" y="([\d.]+)"', tabela).group(1))
+    y_linha_cabecalho, fim_original = linhas_svg[0], linhas_svg[-1]
+    primeira_linha = float(re.findall(r'<text x="[\d.]+" y="([\d.]+)"', tabela)[2])
+    
+    def texto(x, y, estilo, conteudo):
+        return f'  <text x="{x}" y="{_coordenada(y)}" {estilo}>\n    {conteudo}\n  </text>\n  \n'
+    
+    margem_linha = 3  # da linha de base do texto até o traço abaixo dele
+    
+    def linha(x1, x2, y):
+        y = _coordenada(y)
+        return f'  <line x1="{x1}" y1="{y}" x2="{x2}" y2="{y}" {estilo_linha}/>\n  \n'
+    
+    partes = ['  <!-- Tabela -->\n']
+    for x_numero, x_iccid, x_fim in COLUNAS_TABELA[colunas]:
+        partes.append(texto(x_numero, y_cabecalho, estilo_cabecalho, rotulo_numero))
+        partes.append(texto(x_iccid, y_cabecalho, estilo_cabecalho, rotulo_iccid))
+        partes.append(linha(x_numero, x_fim, y_linha_cabecalho))
+    
+    for indice in range(capacidade):
+        coluna, posicao = divmod(indice, linhas)
+        x_numero, x_iccid, x_fim = COLUNAS_TABELA[colunas][coluna]
+        y = primeira_linha + posicao * PASSO_LINHA_AMPLIADO
+        if indice:
+            partes.append(f'  <!-- Linha {indice + 1} -->\n')
+        partes.append(texto(x_numero, y, estilo_texto, campo_numero))
+        partes.append(texto(x_iccid, y, estilo_texto, campo_iccid))
+        partes.append(linha(x_numero, x_fim, y + margem_linha))
+    
+    # Texto de contato, assinatura e código do cliente descem o que a tabela cresceu
+    deslocamento = primeira_linha + (linhas - 1) * PASSO_LINHA_AMPLIADO + margem_linha - fim_original
+    rodape = re.sub(r'\by="([\d.]+)"',
+                    lambda m: f'y="{_coordenada(float(m.group(1)) + deslocamento)}"',
+                    svg_base[fim_tabela:])
+    return svg_base[:inicio_tabela] + ''.join(partes) + rodape
+
+def gerar_templates_ampliados():
+    """
+    Gera carta_{N}_numeros.svg para cada capacidade de CAPACIDADES_AMPLIADAS
+    que não exista ou seja mais antigo que o template base.
+    """
+    base_path = os.path.join(TEMPLATE_FOLDER, TEMPLATE_BASE_AMPLIADO)
+    try:
+        mtime_base = os.stat(base_path).st_mtime
+    except FileNotFoundError:
+        return
+    
+    svg_base = None
+    for capacidade in CAPACIDADES_AMPLIADAS:
+        template_path = os.path.join(TEMPLATE_FOLDER, f'carta_{capacidade}_numeros.svg')
+        if os.path.exists(template_path) and os.stat(template_path).st_mtime >= mtime_base:
+            continue
+        try:
+            if svg_base is None:
+                with open(base_path, 'r', encoding='utf-8') as f:
+                    svg_base = f.read()
+            conteudo = gerar_template_ampliado(svg_base, capacidade)
+            # Escrita atômica: quem ler o template nunca vê um SVG pela metade
+            temporario = f'{template_path}.{uuid.uuid4().hex}.tmp'
+            with open(temporario, 'w', encoding='utf-8') as f:
+                f.write(conteudo)
+            os.replace(temporario, template_path)
+            logger.info('Template %s gerado a partir de %s', os.path.basename(template_path), TEMPLATE_BASE_AMPLIADO)
+        except (OSError, ValueError) as e:
+            logger.warning('Não foi possível gerar o template de %d números: %s', capacidade, e)
+
+# Capacidades dos templates existentes, listadas uma vez por processo (em precompilar_templates)
+_capacidades_templates = None
+
+def capacidades_templates():
+    """Capacidades (números por carta) dos templates carta_N_numero(s).svg existentes"""
+    global _capacidades_templates
+    if _capacidades_templates is None:
+        capacidades = set()
+        for nome in os.listdir(TEMPLATE_FOLDER):
+            correspondencia = _PADRAO_TEMPLATE_CARTA.match(nome)
+            if correspondencia:
+                capacidades.add(int(correspondencia.group(1)))
+        _capacidades_templates = sorted(capacidades)
+    return _capacidades_templates
+
+def numeros_por_carta(empacotar=False):
+    """
+    Máximo de números por carta: 6 no modo padrão; no modo de empacotamento,
+    a maior capacidade disponível, o que dá o menor número de cartas possível
+    (o resto de cada cliente vai para o menor template em que cabe).
+    """
+    if not empacotar:
+        return 6
+    return max(capacidades_templates() + [6])
+
+def precompilar_templates():
+    """Gera os templates ampliados e compila todos os templates carta_*.svg na inicialização"""
+    global _capacidades_templates
+    import glob
+    # Só o processo principal grava templates; os processos dos pools apenas os leem
+    if multiprocessing.parent_process() is None:
+        gerar_templates_ampliados()
+    _capacidades_templates = None
+    capacidades_templates()
+    for template_path in sorted(glob.glob(os.path.join(TEMPLATE_FOLDER, 'carta_*.svg'))):
+        carregar_template(os.path.basename(template_path))
+
+# Templates compilados de replace_placeholders: (svg, colunas) -> TemplateCompilado
+_templates_replace = {}
 
 def replace_placeholders(svg_content, row_data, selected_columns):
     """
     Substitui placeholders no SVG usando diferentes formatos
     """
-    current_svg = svg_content
-    
-    for column in selected_columns:
+    colunas = tuple(selected_columns)
+    chave = (svg_content, colunas)
+    template = _templates_replace.get(chave)
+    if template is None:
+        if len(_templates_replace) >= 32:
+            _templates_replace.clear()
+        template = compilar_template(svg_content, colunas, tags_texto=True)
+        _templates_replace[chave] = template
+
+    valores = {}
+    for column in colunas:
         if column not in row_data or row_data[column] is None:
-            value = ''
+            valores[column] = ''
         else:
-            value = str(row_data[column])
-        
-        # Diferentes formatos de placeholder
-        placeholders = [
-            f'{{{{{column}}}}}',  # {{coluna}}
-            f'[{column}]',        # [coluna]
-            f'{{{column}}}',      # {coluna}
-            f'%{column}%',        # %coluna%
-            f'${column}$',        # $coluna$
-            f'#{column}#',        # #coluna#
-        ]
-        
-        # Substituir cada formato
-        for placeholder in placeholders:
-            current_svg = current_svg.replace(placeholder, value)
-        
-        # Também procurar por placeholders em tags tspan
-        # Padrão: <tspan>coluna</tspan> ou <tspan x="..." y="...">coluna</tspan>
-        tspan_pattern = rf'<tspan[^>]*>\s*{re.escape(column)}\s*</tspan>'
-        current_svg = re.sub(tspan_pattern, f'<tspan>{value}</tspan>', current_svg)
-        
-        # Procurar por placeholders em elementos text
-        text_pattern = rf'<text[^>]*>\s*{re.escape(column)}\s*</text>'
-        current_svg = re.sub(text_pattern, f'<text>{value}</text>', current_svg)
-    
-    return current_svg
+            valores[column] = str(row_data[column])
+
+    return template.render(valores)
+
+precompilar_templates()
 
 @app.route('/')
 def home():
@@ -161,13 +787,68 @@ def debug():
             'uploads_folder': UPLOAD_FOLDER,
             'temp_folder': TEMP_FOLDER,
             'templates_count': len(glob.glob(f"{TEMPLATE_FOLDER}/*.svg")),
-            'templates': [os.path.basename(f) for f in glob.glob(f"{TEMPLATE_FOLDER}/*.svg")]
+            'templates': [os.path.basename(f) for f in glob.glob(f"{TEMPLATE_FOLDER}/*.svg")],
+            'fontes': verificar_fontes(),
+            'armazenamento': uso_armazenamento()
         }
         return jsonify(info)
     except Exception as e:
         return jsonify({'status': 'ERROR', 'message': str(e)}), 500
 
+def tamanho_pasta(pasta):
+    """Soma do tamanho dos arquivos de uma pasta, incluindo subpastas"""
+    total = 0
+    with os.scandir(pasta) as entradas:
+        for entrada in entradas:
+            try:
+                if entrada.is_file():
+                    total += entrada.stat().st_size
+                elif entrada.is_dir():
+                    total += tamanho_pasta(entrada.path)
+            except FileNotFoundError:
+                pass
+    return total
+
+def uso_armazenamento():
+    """
+    Uso de disco, cotas e jobs guardados, para /debug. Os tamanhos das pastas são os
+    medidos na última limpeza (None antes dela): percorrer as pastas a cada request não
+    tem limite, já que o cache pode guardar milhares de arquivos.
+    """
+    with closing(_conexao_jobs()) as conexao:
+        jobs_no_banco = conexao.execute('SELECT COUNT(*) FROM jobs').fetchone()[0]
+    pastas_bytes = _ultima_limpeza.get('pastas_bytes', {})
+    return {
+        'uploads_bytes': pastas_bytes.get(UPLOAD_FOLDER),
+        'temp_bytes': pastas_bytes.get(TEMP_FOLDER),
+        'temp_max_bytes': app.config['TEMP_MAX_BYTES'],
+        'cache_bytes': pastas_bytes.get(CACHE_FOLDER),
+        'output_ttl': app.config['OUTPUT_TTL'],
+        'upload_ttl': app.config['UPLOAD_TTL'],
+        'jobs_ttl': app.config['JOBS_TTL'],
+        'jobs_em_memoria': len(jobs),
+        'jobs_no_banco': jobs_no_banco,
+        'ultima_limpeza': _ultima_limpeza or None,
+    }
+
+@app.route('/metrics')
+def metrics():
+    gauges = {}
+    for job in list(jobs.values()):
+        chave = ('cartas_jobs', (('status', job['status']),))
+        gauges[chave] = gauges.get(chave, 0) + 1
+    with closing(_conexao_jobs()) as conexao:
+        for status, quantidade in conexao.execute('SELECT status, COUNT(*) FROM jobs GROUP BY status'):
+            gauges[('cartas_fila_jobs', (('status', status),))] = quantidade
+    # Tamanhos medidos na última limpeza, sem percorrer as pastas a cada coleta
+    for pasta, tamanho in _ultima_limpeza.get('pastas_bytes', {}).items():
+        gauges[('cartas_pasta_bytes', (('pasta', pasta),))] = tamanho
+    gauges[('cartas_sse_conexoes', ())] = _conexoes_sse[0]
+    
+    return metricas.exportar(gauges), 200, {'Content-Type': 'text/plain; version=0.0.4; charset=utf-8'}
+
 @app.route('/api/upload-excel', methods=['POST'])
+@medir_requisicao('upload_excel')
 def upload_excel():
     try:
         if 'file' not in request.files:
@@ -183,20 +864,231 @@ def upload_excel():
         filename = secure_filename(file.filename)
         filepath = os.path.join(UPLOAD_FOLDER, filename)
         file.save(filepath)
+        metricas.incrementar('cartas_uploads_total')
+        metricas.incrementar('cartas_uploads_bytes_total', os.path.getsize(filepath))
         
-        # Ler dados do Excel usando openpyxl
-        columns, data = read_excel_with_openpyxl(filepath)
+        # Só o cabeçalho no request; o cache colunar é montado em segundo plano
+        columns, total_linhas = ler_cabecalhos_planilha(filepath)
+        preparar_planilha_em_segundo_plano(filepath)
         
         return jsonify({
             'message': 'Arquivo Excel carregado com sucesso',
             'filename': filename,
             'columns': columns,
-            'rows': len(data)
+            'rows': total_linhas
         })
     
     except Exception as e:
         return jsonify({'error': f'Erro ao processar arquivo: {str(e)}'}), 500
 
+# Upload em partes (retomável)
+#
+# POST /api/upload-excel/iniciar cria o upload; cada PUT /api/upload-excel/<id> envia uma
+# parte com Content-Range e é gravado direto no disco, sem passar pela memória; GET
+# informa quantos bytes já chegaram para retomar após uma falha. O SHA-256 é calculado
+# à medida que as partes chegam e, ao final, só o cabeçalho é lido no request: o cache
+# colunar da planilha é montado em segundo plano.
+
+TAMANHO_PARTE_UPLOAD = 4 * 1024 * 1024
+_PADRAO_UPLOAD_ID = re.compile(r'^[0-9a-f]{32}$')
+_PADRAO_CONTENT_RANGE = re.compile(r'^bytes (\d+)-(\d+)/(\d+)$')
+
+# Hash parcial dos uploads em andamento neste processo: upload_id -> (bytes, sha256)
+_hashes_uploads = {}
+_locks_uploads = {}
+_uploads_lock = threading.Lock()
+_planilhas_em_preparo = set()
+
+def _caminho_upload_parcial(upload_id):
+    return os.path.join(UPLOAD_FOLDER, f'.parcial_{upload_id}')
+
+def _ler_estado_upload(upload_id):
+    if not _PADRAO_UPLOAD_ID.match(upload_id):
+        return None
+    try:
+        with open(_caminho_upload_parcial(upload_id) + '.json') as f:
+            estado = json.load(f)
+    except FileNotFoundError:
+        return None
+    estado['recebidos'] = os.path.getsize(_caminho_upload_parcial(upload_id))
+    return estado
+
+def _lock_do_upload(upload_id):
+    """Lock que serializa as partes de um mesmo upload neste processo"""
+    with _uploads_lock:
+        return _locks_uploads.setdefault(upload_id, threading.Lock())
+
+def _hash_parcial(upload_id, recebidos):
+    """SHA-256 dos bytes já recebidos; refeito a partir do disco se outro processo recebeu as partes anteriores"""
+    entrada = _hashes_uploads.get(upload_id)
+    if entrada is None or entrada[0] != recebidos:
+        sha = hashlib.sha256()
+        with open(_caminho_upload_parcial(upload_id), 'rb') as f:
+            for bloco in iter(lambda: f.read(1024 * 1024), b''):
+                sha.update(bloco)
+        entrada = (recebidos, sha)
+    return entrada[1]
+
+def podar_memorias_uploads():
+    """
+    Descarta hashes e locks memorizados de arquivos e uploads que não existem mais
+    (removidos pela limpeza deste ou de outro processo, ou concluídos em outro processo)
+    """
+    for filepath in list(_hashes_arquivos):
+        if not os.path.exists(filepath):
+            _hashes_arquivos.pop(filepath, None)
+    with _uploads_lock:
+        for upload_id in set(_hashes_uploads) | set(_locks_uploads):
+            if not os.path.exists(_caminho_upload_parcial(upload_id) + '.json'):
+                _hashes_uploads.pop(upload_id, None)
+                _locks_uploads.pop(upload_id, None)
+
+def preparar_planilha_em_segundo_plano(filepath):
+    """Monta o cache colunar da planilha (no pool de CPU) sem bloquear o request, se ainda não existe"""
+    if os.path.exists(_caminho_cache_planilha(hash_arquivo(filepath))):
+        return
+    with _uploads_lock:
+        if filepath in _planilhas_em_preparo:
+            return
+        _planilhas_em_preparo.add(filepath)
+    
+    def preparar():
+        try:
+            inicio = time.perf_counter()
+            _, total_linhas = carregar_planilha(filepath)
+            logger.info('Planilha %s pronta no cache: %d linhas em %.2fs', filepath, total_linhas,
+                        time.perf_counter() - inicio)
+        except Exception:
+            logger.exception('Erro ao preparar a planilha %s', filepath)
+        finally:
+            with _uploads_lock:
+                _planilhas_em_preparo.discard(filepath)
+    
+    threading.Thread(target=preparar, daemon=True).start()
+
+def _concluir_upload(upload_id, estado, sha):
+    """Move o arquivo completo para UPLOAD_FOLDER e responde só com os cabeçalhos"""
+    filepath = os.path.join(UPLOAD_FOLDER, estado['filename'])
+    os.replace(_caminho_upload_parcial(upload_id), filepath)
+    os.remove(_caminho_upload_parcial(upload_id) + '.json')
+    _hashes_uploads.pop(upload_id, None)
+    with _uploads_lock:
+        _locks_uploads.pop(upload_id, None)
+    
+    # O hash calculado durante o upload evita reler o arquivo em hash_arquivo
+    stat = os.stat(filepath)
+    _hashes_arquivos[filepath] = ((stat.st_size, stat.st_mtime_ns), sha.hexdigest())
+    metricas.incrementar('cartas_uploads_total')
+    metricas.incrementar('cartas_uploads_bytes_total', stat.st_size)
+    
+    # Cabeçalho lido no pool de CPU; o cache colunar é montado em segundo plano
+    columns, total_linhas = ler_cabecalhos_planilha(filepath)
+    preparar_planilha_em_segundo_plano(filepath)
+    return jsonify({
+        'message': 'Arquivo Excel carregado com sucesso',
+        'filename': estado['filename'],
+        'columns': columns,
+        'rows': total_linhas,
+        'sha256': sha.hexdigest(),
+        'recebidos': stat.st_size,
+        'tamanho': estado['tamanho'],
+        'completo': True
+    })
+
+@app.route('/api/upload-excel/iniciar', methods=['POST'])
+def iniciar_upload_excel():
+    try:
+        data = request.get_json()
+        filename = secure_filename(data.get('filename', ''))
+        tamanho = int(data.get('tamanho', 0))
+        
+        if not filename:
+            return jsonify({'error': 'Nenhum arquivo selecionado'}), 400
+        if not filename.endswith(('.xlsx', '.xls')):
+            return jsonify({'error': 'Apenas arquivos Excel são permitidos'}), 400
+        if tamanho <= 0:
+            return jsonify({'error': 'Tamanho do arquivo é obrigatório'}), 400
+        if tamanho > app.config['UPLOAD_MAX_BYTES']:
+            return jsonify({'error': f'Arquivo maior que o limite de {app.config["UPLOAD_MAX_BYTES"]} bytes'}), 413
+        
+        upload_id = uuid.uuid4().hex
+        with open(_caminho_upload_parcial(upload_id) + '.json', 'w') as f:
+            json.dump({'filename': filename, 'tamanho': tamanho}, f)
+        open(_caminho_upload_parcial(upload_id), 'wb').close()
+        
+        return jsonify({'upload_id': upload_id, 'recebidos': 0, 'tamanho_parte': TAMANHO_PARTE_UPLOAD})
+    
+    except Exception as e:
+        return jsonify({'error': f'Erro ao iniciar upload: {str(e)}'}), 500
+
+@app.route('/api/upload-excel/<upload_id>', methods=['GET'])
+def status_upload_excel(upload_id):
+    estado = _ler_estado_upload(upload_id)
+    if estado is None:
+        return jsonify({'error': 'Upload não encontrado'}), 404
+    return jsonify({'upload_id': upload_id, 'recebidos': estado['recebidos'], 'tamanho': estado['tamanho']})
+
+@app.route('/api/upload-excel/<upload_id>', methods=['PUT'])
+@medir_requisicao('upload_excel_parte')
+def enviar_parte_upload_excel(upload_id):
+    try:
+        faixa = _PADRAO_CONTENT_RANGE.match(request.headers.get('Content-Range', ''))
+        if not faixa:
+            return jsonify({'error': 'Content-Range obrigatório (bytes inicio-fim/total)'}), 400
+        inicio, fim, total = (int(valor) for valor in faixa.groups())
+        if not _PADRAO_UPLOAD_ID.match(upload_id):
+            return jsonify({'error': 'Upload não encontrado'}), 404
+        
+        with _lock_do_upload(upload_id):
+            estado = _ler_estado_upload(upload_id)
+            if estado is None:
+                return jsonify({'error': 'Upload não encontrado'}), 404
+            if total != estado['tamanho'] or fim < inicio or fim >= total:
+                return jsonify({'error': 'Content-Range inválido'}), 400
+            if inicio != estado['recebidos']:
+                # Parte fora de ordem (ou repetida): o cliente retoma a partir de 'recebidos'
+                return jsonify({'error': 'Parte fora de ordem', 'recebidos': estado['recebidos']}), 409
+            
+            # O TTL de uploads conta da última parte recebida, não do início do upload
+            os.utime(_caminho_upload_parcial(upload_id) + '.json')
+            
+            sha = _hash_parcial(upload_id, estado['recebidos'])
+            esperado = fim - inicio + 1
+            gravados = 0
+            with open(_caminho_upload_parcial(upload_id), 'ab') as f:
+                while gravados < esperado:
+                    bloco = request.stream.read(min(1024 * 1024, esperado - gravados))
+                    if not bloco:
+                        break
+                    f.write(bloco)
+                    sha.update(bloco)
+                    gravados += len(bloco)
+                if gravados != esperado:
+                    # Parte incompleta é descartada para manter arquivo e hash consistentes
+                    f.truncate(estado['recebidos'])
+                    _hashes_uploads.pop(upload_id, None)
+                    return jsonify({'error': 'Parte incompleta', 'recebidos': estado['recebidos']}), 400
+            recebidos = estado['recebidos'] + gravados
+            _hashes_uploads[upload_id] = (recebidos, sha)
+            
+            if recebidos == estado['tamanho']:
+                return _concluir_upload(upload_id, estado, sha)
+        return jsonify({'upload_id': upload_id, 'recebidos': recebidos, 'tamanho': estado['tamanho'], 'completo': False})
+    
+    except Exception as e:
+        return jsonify({'error': f'Erro ao receber parte do upload: {str(e)}'}), 500
+
+def prioridade_do_pedido(data):
+    """Prioridade do pedido (inteiro, ou texto com um inteiro; padrão 0), ou None se inválida"""
+    valor = data.get('prioridade')
+    if valor is None:
+        return 0
+    if isinstance(valor, str) and re.fullmatch(r'[+-]?\d+', valor.strip()):
+        return int(valor)
+    if isinstance(valor, int) and not isinstance(valor, bool):
+        return valor
+    return None
+
 @app.route('/api/generate-pdfs-por-cliente', methods=['POST'])
 def generate_pdfs_por_cliente():
     try:
@@ -205,280 +1097,1594 @@ def generate_pdfs_por_cliente():
         coluna_cliente = data.get('coluna_cliente', 'Cliente')
         coluna_numero = data.get('coluna_numero', 'Número')
         coluna_iccid = data.get('coluna_iccid', 'ICCID')
+        prioridade = prioridade_do_pedido(data)
         
         if not excel_file:
             return jsonify({'error': 'Arquivo Excel é obrigatório'}), 400
+        if prioridade is None:
+            return jsonify({'error': 'Prioridade deve ser um número inteiro'}), 400
         
         # Gerar ID único para o job
         job_id = str(uuid.uuid4())
         
-        # Iniciar job em background
-        thread = threading.Thread(
-            target=process_pdf_generation_por_cliente,
-            args=(job_id, excel_file, coluna_cliente, coluna_numero, coluna_iccid)
-        )
-        thread.daemon = True
-        thread.start()
+        # Colocar o job na fila; o agendador inicia quando houver capacidade
+        params = {
+            'tipo': 'por_cliente',
+            'excel_file': excel_file,
+            'coluna_cliente': coluna_cliente,
+            'coluna_numero': coluna_numero,
+            'coluna_iccid': coluna_iccid,
+            'entrega_em_partes': bool(data.get('entrega_em_partes', False)),
+            'empacotar': bool(data.get('empacotar', app.config['EMPACOTAR_CARTAS'])),
+        }
+        posicao = enfileirar_job(job_id, params, prioridade)
+        
+        if posicao is None:
+            response = jsonify({
+                'error': 'Fila de geração cheia, tente novamente mais tarde',
+                'posicao': app.config['FILA_MAX'] + 1
+            })
+            response.headers['Retry-After'] = '30'
+            return response, 429
         
         return jsonify({
             'message': 'Geração de PDFs por cliente iniciada',
-            'job_id': job_id
+            'job_id': job_id,
+            'posicao': posicao
         })
     
     except Exception as e:
         return jsonify({'error': f'Erro ao iniciar geração: {str(e)}'}), 500
 
-def process_pdf_generation_por_cliente(job_id, excel_file, coluna_cliente, coluna_numero, coluna_iccid):
+@app.route('/api/generate-pdfs-lote', methods=['POST'])
+def generate_pdfs_lote():
+    """
+    Enfileira um único job para várias planilhas. Corpo:
+    {"planilhas": [{"excel_file", "coluna_cliente", "coluna_numero", "coluna_iccid"}, ...],
+     "saida": "pdf" (um PDF combinado) ou "zip" (um PDF por planilha), "prioridade", "empacotar"}
+    """
     try:
-        jobs[job_id] = {'status': 'processing', 'progress': 0, 'message': 'Iniciando processamento por cliente...'}
+        data = request.get_json()
+        saida = data.get('saida', 'pdf')
+        prioridade = prioridade_do_pedido(data)
+        
+        if not data.get('planilhas'):
+            return jsonify({'error': 'Lista de planilhas é obrigatória'}), 400
+        if prioridade is None:
+            return jsonify({'error': 'Prioridade deve ser um número inteiro'}), 400
+        if saida not in ('pdf', 'zip'):
+            return jsonify({'error': 'Saída deve ser pdf ou zip'}), 400
+        
+        planilhas = []
+        for planilha in data['planilhas']:
+            excel_file = planilha.get('excel_file')
+            if not excel_file:
+                return jsonify({'error': 'Arquivo Excel é obrigatório em cada planilha'}), 400
+            if not os.path.exists(os.path.join(UPLOAD_FOLDER, excel_file)):
+                return jsonify({'error': f'Arquivo Excel não encontrado: {excel_file}'}), 404
+            planilhas.append({
+                'excel_file': excel_file,
+                'coluna_cliente': planilha.get('coluna_cliente', 'Cliente'),
+                'coluna_numero': planilha.get('coluna_numero', 'Número'),
+                'coluna_iccid': planilha.get('coluna_iccid', 'ICCID'),
+            })
+        
+        job_id = str(uuid.uuid4())
+        params = {
+            'tipo': 'lote',
+            'planilhas': planilhas,
+            'saida': saida,
+            'empacotar': bool(data.get('empacotar', app.config['EMPACOTAR_CARTAS'])),
+        }
+        posicao = enfileirar_job(job_id, params, prioridade)
+        
+        if posicao is None:
+            response = jsonify({
+                'error': 'Fila de geração cheia, tente novamente mais tarde',
+                'posicao': app.config['FILA_MAX'] + 1
+            })
+            response.headers['Retry-After'] = '30'
+            return response, 429
+        
+        return jsonify({
+            'message': f'Geração em lote iniciada ({len(planilhas)} planilhas)',
+            'job_id': job_id,
+            'posicao': posicao
+        })
+    
+    except Exception as e:
+        return jsonify({'error': f'Erro ao iniciar geração em lote: {str(e)}'}), 500
+
+@app.route('/api/dry-run-por-cliente', methods=['POST'])
+@medir_requisicao('dry_run_por_cliente')
+def dry_run_por_cliente():
+    """
+    Conta as cartas que a geração por cliente produziria, por template, sem renderizar.
+    Com "empacotar", conta no modo de empacotamento e informa também o total do modo padrão.
+    """
+    try:
+        data = request.get_json()
+        excel_file = data.get('excel_file')
+        coluna_cliente = data.get('coluna_cliente', 'Cliente')
+        coluna_numero = data.get('coluna_numero', 'Número')
+        coluna_iccid = data.get('coluna_iccid', 'ICCID')
+        
+        if not excel_file:
+            return jsonify({'error': 'Arquivo Excel é obrigatório'}), 400
         
-        # Ler dados do Excel
         excel_path = os.path.join(UPLOAD_FOLDER, excel_file)
-        columns, data = read_excel_with_openpyxl(excel_path)
+        if not os.path.exists(excel_path):
+            return jsonify({'error': 'Arquivo Excel não encontrado'}), 404
         
-        # Agrupar dados por cliente
-        clientes = agrupar_por_cliente(data, coluna_cliente)
+        empacotar = bool(data.get('empacotar', app.config['EMPACOTAR_CARTAS']))
+        resultado = executar_no_pool_cpu(contar_cartas_planilha, excel_path, coluna_cliente,
+                                         coluna_numero, coluna_iccid, empacotar)
+        resultado['excel_file'] = excel_file
+        return jsonify(resultado)
+    
+    except Exception as e:
+        return jsonify({'error': f'Erro ao contar cartas: {str(e)}'}), 500
+
+@app.route('/api/validate-excel', methods=['POST'])
+@medir_requisicao('validate_excel')
+def validate_excel():
+    """Valida as colunas escolhidas em segundos, antes de iniciar a geração"""
+    try:
+        data = request.get_json()
+        excel_file = data.get('excel_file')
+        if not excel_file:
+            return jsonify({'error': 'Arquivo Excel é obrigatório'}), 400
         
-        # Log da ordem dos clientes
-        clientes_ordenados = list(clientes.keys())
-        print(f"📋 Clientes processados em ordem das linhas do Excel:")
-        for i, cliente in enumerate(clientes_ordenados, 1):
-            print(f"  {i}. {cliente}")
+        excel_path = os.path.join(UPLOAD_FOLDER, excel_file)
+        if not os.path.exists(excel_path):
+            return jsonify({'error': 'Arquivo Excel não encontrado'}), 404
         
-        jobs[job_id]['progress'] = 10
-        jobs[job_id]['message'] = f'Processando {len(clientes)} clientes em ordem das linhas do Excel...'
+        relatorio = executar_no_pool_cpu(validar_planilha, excel_path, data.get('coluna_cliente', 'Cliente'),
+                                         data.get('coluna_numero', 'Número'), data.get('coluna_iccid', 'ICCID'))
+        relatorio['excel_file'] = excel_file
+        return jsonify(relatorio)
+    
+    except Exception as e:
+        return jsonify({'error': f'Erro ao validar planilha: {str(e)}'}), 500
+
+def numeros_do_cliente(registros_cliente, coluna_numero, coluna_iccid):
+    """Números e ICCIDs de um cliente; linhas sem um dos dois são ignoradas"""
+    numeros_cliente = []
+    for registro in registros_cliente:
+        numero = registro.get(coluna_numero, '')
+        iccid = registro.get(coluna_iccid, '')
+        if numero and iccid:
+            numeros_cliente.append({
+                'numero': str(numero),
+                'iccid': str(iccid)
+            })
+    return numeros_cliente
+
+def contar_cartas(clientes, coluna_numero, coluna_iccid, max_por_carta=6):
+    """
+    Conta as cartas que gerar_cartas vai produzir, sem renderizar nada.
+    Retorna {quantidade de números na carta: cartas}.
+    """
+    cartas_por_quantidade = defaultdict(int)
+    for registros_cliente in clientes.values():
+        numeros_cliente = numeros_do_cliente(registros_cliente, coluna_numero, coluna_iccid)
+        for grupo in dividir_numeros_por_carta(numeros_cliente, max_por_carta):
+            cartas_por_quantidade[len(grupo)] += 1
+    return dict(sorted(cartas_por_quantidade.items()))
+
+def total_de_cartas(cartas_por_quantidade):
+    """Total de cartas geradas; grupos cujo template não existe são pulados por gerar_cartas"""
+    return sum(cartas for quantidade, cartas in cartas_por_quantidade.items()
+               if carregar_template(selecionar_template(quantidade)) is not None)
+
+def contar_cartas_planilha(excel_path, coluna_cliente, coluna_numero, coluna_iccid, empacotar=False):
+    """Resumo do dry-run: clientes e cartas por template (no pool de CPU)"""
+    _, colunas = ler_colunas_planilha(excel_path, [coluna_cliente, coluna_numero, coluna_iccid])
+    clientes = agrupar_por_cliente(linhas_de_colunas(colunas), coluna_cliente)
+    cartas_por_quantidade = contar_cartas(clientes, coluna_numero, coluna_iccid, numeros_por_carta(empacotar))
+    
+    templates = []
+    for quantidade, cartas in cartas_por_quantidade.items():
+        template_file = selecionar_template(quantidade)
+        templates.append({
+            'template': template_file,
+            'numeros_por_carta': quantidade,
+            'cartas': cartas,
+            'disponivel': carregar_template(template_file) is not None
+        })
+    
+    resultado = {
+        'clientes': len(clientes),
+        'empacotar': empacotar,
+        'total_cartas': total_de_cartas(cartas_por_quantidade),
+        'templates': templates
+    }
+    if empacotar:
+        resultado['total_cartas_sem_empacotar'] = total_de_cartas(contar_cartas(clientes, coluna_numero, coluna_iccid))
+    return resultado
+
+# Validação rápida da planilha, sobre as colunas do cache (sem renderizar nada)
+DIGITOS_ICCID = (19, 20)  # ITU-T E.118, incluindo o dígito verificador
+DIGITOS_TELEFONE = (9, 13)  # número nacional, com ou sem código do país
+EXEMPLOS_POR_PROBLEMA = 5
+# Explicação enviada junto com problemas cujo nome não basta para corrigir a planilha
+MENSAGENS_PROBLEMAS = {
+    'iccid_numerico': 'ICCID armazenado como número — formate a coluna como texto',
+}
+_PADRAO_TELEFONE = re.compile(r'^\+?[\d\s().-]+$')
+
+def texto_celula(valor):
+    """Valor da célula como texto; números inteiros vindos do Excel perdem o '.0'"""
+    if valor is None:
+        return ''
+    if isinstance(valor, float) and valor.is_integer():
+        valor = int(valor)
+    return str(valor).strip()
+
+def luhn_valido(digitos):
+    """Confere o dígito verificador (Luhn) de uma sequência de dígitos"""
+    soma = 0
+    for posicao, digito in enumerate(reversed(digitos)):
+        valor = ord(digito) - 48
+        if posicao % 2:
+            valor *= 2
+            if valor > 9:
+                valor -= 9
+        soma += valor
+    return soma % 10 == 0
+
+def validar_colunas(clientes, numeros, iccids, numeros_linhas):
+    """
+    Valida as colunas (listas alinhadas por linha) e retorna {problema: [(linha, valor), ...]},
+    com linha = número da linha no Excel (numeros_linhas, do cache).
+    Erros impedem cartas corretas; avisos indicam linhas que a geração ignora.
+    """
+    erros = defaultdict(list)
+    avisos = defaultdict(list)
+    clientes_do_numero = {}
+    clientes_do_iccid = {}
+    
+    for linha, cliente, numero, iccid_celula in zip(numeros_linhas, clientes, numeros, iccids):
+        cliente, numero, iccid = texto_celula(cliente), texto_celula(numero), texto_celula(iccid_celula)
         
-        # Lista para armazenar PDFs gerados
-        pdf_files = []
-        total_cartas = 0
+        if not numero or not iccid:
+            avisos['linha_sem_numero_ou_iccid'].append((linha, numero or iccid))
+            continue
+        if not cliente:
+            erros['cliente_vazio'].append((linha, numero))
         
-        for cliente_nome, registros_cliente in clientes.items():
-            try:
-                # Extrair números e ICCIDs do cliente
-                numeros_cliente = []
-                for registro in registros_cliente:
-                    numero = registro.get(coluna_numero, '')
-                    iccid = registro.get(coluna_iccid, '')
-                    if numero and iccid:
-                        numeros_cliente.append({
-                            'numero': str(numero),
-                            'iccid': str(iccid)
-                        })
+        # Célula numérica: o Excel guarda só 15 dígitos significativos, então os últimos
+        # dígitos de um ICCID de 19-20 já se perderam e não há o que validar
+        iccid_numerico = isinstance(iccid_celula, (int, float)) and not isinstance(iccid_celula, bool)
+        if iccid_numerico:
+            erros['iccid_numerico'].append((linha, str(iccid_celula)))
+        elif not iccid.isdigit() or not DIGITOS_ICCID[0] <= len(iccid) <= DIGITOS_ICCID[1]:
+            erros['iccid_formato'].append((linha, iccid))
+        elif not luhn_valido(iccid):
+            erros['iccid_digito_verificador'].append((linha, iccid))
+        
+        digitos = re.sub(r'\D', '', numero)
+        if not _PADRAO_TELEFONE.match(numero) or not DIGITOS_TELEFONE[0] <= len(digitos) <= DIGITOS_TELEFONE[1]:
+            erros['telefone_formato'].append((linha, numero))
+        
+        # Duplicados: no mesmo cliente é aviso, entre clientes diferentes é erro
+        for valor, vistos, tipo in ((digitos or numero, clientes_do_numero, 'numero'), (iccid, clientes_do_iccid, 'iccid')):
+            if tipo == 'iccid' and iccid_numerico:
+                continue
+            anterior = vistos.get(valor)
+            if anterior is None:
+                vistos[valor] = cliente
+            elif anterior != cliente:
+                erros[f'{tipo}_em_varios_clientes'].append((linha, valor))
+            else:
+                avisos[f'{tipo}_duplicado'].append((linha, valor))
+    
+    return erros, avisos
+
+def _resumir_problemas(problemas):
+    return {
+        tipo: {
+            'quantidade': len(ocorrencias),
+            'exemplos': [{'linha': linha, 'valor': valor} for linha, valor in ocorrencias[:EXEMPLOS_POR_PROBLEMA]],
+            **({'mensagem': MENSAGENS_PROBLEMAS[tipo]} if tipo in MENSAGENS_PROBLEMAS else {})
+        }
+        for tipo, ocorrencias in problemas.items()
+    }
+
+def validar_planilha(excel_path, coluna_cliente, coluna_numero, coluna_iccid):
+    """Relatório compacto de validação das colunas escolhidas"""
+    headers, colunas, numeros_linhas = ler_colunas_planilha(
+        excel_path, [coluna_cliente, coluna_numero, coluna_iccid], numeros_linhas=True)
+    ausentes = [coluna for coluna in (coluna_cliente, coluna_numero, coluna_iccid) if coluna not in colunas]
+    if ausentes:
+        return {'valido': False, 'colunas_ausentes': ausentes, 'colunas': headers}
+    
+    erros, avisos = validar_colunas(colunas[coluna_cliente], colunas[coluna_numero], colunas[coluna_iccid],
+                                    numeros_linhas)
+    return {
+        'valido': not erros,
+        'linhas': len(colunas[coluna_cliente]),
+        'clientes': len(set(colunas[coluna_cliente])),
+        'erros': _resumir_problemas(erros),
+        'avisos': _resumir_problemas(avisos),
+    }
+
+def gerar_cartas(clientes, coluna_numero, coluna_iccid, log=None, max_por_carta=6):
+    """
+    Gera (cliente_nome, grupo, template_file, svg) de cada carta, na ordem dos clientes.
+    max_por_carta acima de 6 usa os templates ampliados (ver numeros_por_carta).
+    """
+    log = log or logger
+    for cliente_nome, registros_cliente in clientes.items():
+        try:
+            # Extrair números e ICCIDs do cliente
+            numeros_cliente = numeros_do_cliente(registros_cliente, coluna_numero, coluna_iccid)
+            
+            if not numeros_cliente:
+                continue
+            
+            # Dividir números em grupos de 6 (ou da maior capacidade, ao empacotar)
+            grupos_numeros = dividir_numeros_por_carta(numeros_cliente, max_por_carta)
+            
+            for grupo in grupos_numeros:
+                # Selecionar template baseado na quantidade
+                quantidade = len(grupo)
+                template_file = selecionar_template(quantidade)
+                template = carregar_template(template_file)
                 
-                if not numeros_cliente:
+                if template is None:
+                    log.warning('Template não encontrado: %s', template_file)
                     continue
                 
-                # Dividir números em grupos de 6 se necessário
-                grupos_numeros = dividir_numeros_por_carta(numeros_cliente, 6)
+                if len(grupo) > template.contar('NUMERO'):
+                    log.warning('Template %s tem menos placeholders NUMERO que números no grupo', template_file)
                 
-                for grupo in grupos_numeros:
-                    # Selecionar template baseado na quantidade
-                    quantidade = len(grupo)
-                    template_file = selecionar_template(quantidade)
-                    template_path = os.path.join(TEMPLATE_FOLDER, template_file)
-                    
-                    if not os.path.exists(template_path):
-                        print(f"Template não encontrado: {template_file}")
-                        continue
-                    
-                    # Ler template SVG
-                    with open(template_path, 'r', encoding='utf-8') as f:
-                        svg_content = f.read()
-                    
-                    print(f"Template carregado: {template_file}")
-                    print(f"Quantidade de números: {len(grupo)}")
-                    
-                    # Substituir dados do cliente
-                    svg_modificado = svg_content
-                    
-                    # Substituir nome do cliente
-                    svg_modificado = svg_modificado.replace('{{CLIENTE}}', cliente_nome)
-                    svg_modificado = svg_modificado.replace('[CLIENTE]', cliente_nome)
-                    svg_modificado = svg_modificado.replace('{CLIENTE}', cliente_nome)
-                    svg_modificado = svg_modificado.replace('%CLIENTE%', cliente_nome)
-                    svg_modificado = svg_modificado.replace('$CLIENTE$', cliente_nome)
-                    svg_modificado = svg_modificado.replace('#CLIENTE#', cliente_nome)
-                    
-                    print(f"Cliente substituído: {cliente_nome}")
-                    
-                    # Substituir números e ICCIDs
-                    if len(grupo) == 1:
-                        # Para template com 1 número, usar placeholders simples
-                        numero = grupo[0]['numero']
-                        iccid = grupo[0]['iccid']
-                        
-                        print(f"Substituindo 1 número: {numero}, ICCID: {iccid}")
-                        
-                        svg_modificado = svg_modificado.replace('[NUMERO]', numero)
-                        svg_modificado = svg_modificado.replace('{NUMERO}', numero)
-                        svg_modificado = svg_modificado.replace('{{NUMERO}}', numero)
-                        svg_modificado = svg_modificado.replace('%NUMERO%', numero)
-                        svg_modificado = svg_modificado.replace('$NUMERO$', numero)
-                        svg_modificado = svg_modificado.replace('#NUMERO#', numero)
-                        
-                        svg_modificado = svg_modificado.replace('[ICCID]', iccid)
-                        svg_modificado = svg_modificado.replace('{ICCID}', iccid)
-                        svg_modificado = svg_modificado.replace('{{ICCID}}', iccid)
-                        svg_modificado = svg_modificado.replace('%ICCID%', iccid)
-                        svg_modificado = svg_modificado.replace('$ICCID$', iccid)
-                        svg_modificado = svg_modificado.replace('#ICCID#', iccid)
-                    else:
-                        # Para templates com múltiplos números, substituir sequencialmente
-                        # Primeiro, contar quantos placeholders existem
-                        num_placeholders = svg_modificado.count('[NUMERO]')
-                        iccid_placeholders = svg_modificado.count('[ICCID]')
-                        
-                        print(f"Encontrados {num_placeholders} placeholders NUMERO e {iccid_placeholders} placeholders ICCID")
-                        
-                        # Substituir apenas os placeholders necessários
-                        for i, item in enumerate(grupo):
-                            numero = item['numero']
-                            iccid = item['iccid']
-                            
-                            print(f"Substituindo número {i+1}: {numero}, ICCID: {iccid}")
-                            
-                            # Substituir apenas o primeiro placeholder encontrado
-                            svg_modificado = svg_modificado.replace('[NUMERO]', numero, 1)
-                            svg_modificado = svg_modificado.replace('{NUMERO}', numero, 1)
-                            svg_modificado = svg_modificado.replace('{{NUMERO}}', numero, 1)
-                            svg_modificado = svg_modificado.replace('%NUMERO%', numero, 1)
-                            svg_modificado = svg_modificado.replace('$NUMERO$', numero, 1)
-                            svg_modificado = svg_modificado.replace('#NUMERO#', numero, 1)
-                            
-                            svg_modificado = svg_modificado.replace('[ICCID]', iccid, 1)
-                            svg_modificado = svg_modificado.replace('{ICCID}', iccid, 1)
-                            svg_modificado = svg_modificado.replace('{{ICCID}}', iccid, 1)
-                            svg_modificado = svg_modificado.replace('%ICCID%', iccid, 1)
-                            svg_modificado = svg_modificado.replace('$ICCID$', iccid, 1)
-                            svg_modificado = svg_modificado.replace('#ICCID#', iccid, 1)
-                        
-                        # Limpar placeholders não utilizados
-                        svg_modificado = svg_modificado.replace('[NUMERO]', '')
-                        svg_modificado = svg_modificado.replace('{NUMERO}', '')
-                        svg_modificado = svg_modificado.replace('{{NUMERO}}', '')
-                        svg_modificado = svg_modificado.replace('%NUMERO%', '')
-                        svg_modificado = svg_modificado.replace('$NUMERO$', '')
-                        svg_modificado = svg_modificado.replace('#NUMERO#', '')
-                        
-                        svg_modificado = svg_modificado.replace('[ICCID]', '')
-                        svg_modificado = svg_modificado.replace('{ICCID}', '')
-                        svg_modificado = svg_modificado.replace('{{ICCID}}', '')
-                        svg_modificado = svg_modificado.replace('%ICCID%', '')
-                        svg_modificado = svg_modificado.replace('$ICCID$', '')
-                        svg_modificado = svg_modificado.replace('#ICCID#', '')
-                    
-                    # Gerar PDF temporário
-                    temp_svg = os.path.join(TEMP_FOLDER, f'temp_cliente_{total_cartas}.svg')
-                    temp_pdf = os.path.join(TEMP_FOLDER, f'temp_cliente_{total_cartas}.pdf')
-                    
-                    with open(temp_svg, 'w', encoding='utf-8') as f:
-                        f.write(svg_modificado)
-                    
-                    print(f"Gerando PDF para cliente {cliente_nome} com {len(grupo)} números")
-                    print(f"Template usado: {template_file}")
-                    print(f"SVG salvo em: {temp_svg}")
-                    
-                    # Verificar se ainda há placeholders não substituídos
-                    remaining_placeholders = []
-                    if '[NUMERO]' in svg_modificado:
-                        remaining_placeholders.append('[NUMERO]')
-                    if '[ICCID]' in svg_modificado:
-                        remaining_placeholders.append('[ICCID]')
-                    if '[CLIENTE]' in svg_modificado:
-                        remaining_placeholders.append('[CLIENTE]')
-                    
-                    if remaining_placeholders:
-                        print(f"⚠️  Placeholders não substituídos: {remaining_placeholders}")
-                    
-                    # Converter SVG para PDF
-                    try:
-                        print(f"🔄 Convertendo SVG para PDF...")
-                        print(f"📄 Arquivo SVG: {temp_svg}")
-                        print(f"📄 Arquivo PDF: {temp_pdf}")
-                        
-                        # Verificar fontes disponíveis antes da conversão
-                        try:
-                            import subprocess
-                            result = subprocess.run(['fc-list'], capture_output=True, text=True, timeout=10)
-                            if result.returncode == 0:
-                                fonts = result.stdout
-                                arial_found = 'Arial' in fonts
-                                print(f"🔍 Fontes disponíveis: Arial={'✅' if arial_found else '❌'}")
-                            else:
-                                print("⚠️  Não foi possível verificar fontes")
-                        except Exception as e:
-                            print(f"⚠️  Erro ao verificar fontes: {e}")
-                        
-                        svg2pdf(url=temp_svg, write_to=temp_pdf)
-                        print(f"✅ PDF gerado com sucesso: {temp_pdf}")
-                        pdf_files.append(temp_pdf)
-                        total_cartas += 1
-                    except Exception as e:
-                        print(f"❌ Erro ao converter SVG para PDF: {e}")
-                        print(f"📄 Conteúdo SVG (primeiras 500 chars): {svg_modificado[:500]}...")
-                        continue
+                # Substituir dados do cliente, números e ICCIDs
+                if len(grupo) == 1:
+                    # Para template com 1 número, todas as ocorrências recebem o mesmo valor
+                    numeros = grupo[0]['numero']
+                    iccids = grupo[0]['iccid']
+                else:
+                    # Para templates com múltiplos números, preencher sequencialmente
+                    # (placeholders não utilizados ficam vazios)
+                    numeros = [item['numero'] for item in grupo]
+                    iccids = [item['iccid'] for item in grupo]
                 
-                # Atualizar progresso
-                progress = 10 + int((len(pdf_files) / (len(clientes) * 2)) * 80)  # Estimativa
-                jobs[job_id]['progress'] = min(progress, 90)
-                jobs[job_id]['message'] = f'Processado cliente: {cliente_nome} ({len(grupos_numeros)} cartas)'
+                svg_modificado = template.render({
+                    'CLIENTE': str(cliente_nome),
+                    'NUMERO': numeros,
+                    'ICCID': iccids,
+                })
                 
-            except Exception as e:
-                print(f"Erro ao processar cliente {cliente_nome}: {e}")
-                continue
+                yield cliente_nome, grupo, template_file, svg_modificado
+        
+        except Exception as e:
+            log.error('Erro ao processar cliente %s: %s', cliente_nome, e)
+            continue
+
+# Resultado da verificação de fontes (feita uma vez por processo)
+_fontes = None
+
+def verificar_fontes():
+    """
+    Verifica uma única vez, com fc-list, as fontes usadas pelos templates.
+    O resultado fica em cache e é exibido em /debug.
+    """
+    global _fontes
+    if _fontes is None:
+        fontes = {'fc_list': False, 'familias': 0}
+        try:
+            import subprocess
+            result = subprocess.run(['fc-list', ':', 'family'], capture_output=True, text=True, timeout=10)
+            if result.returncode == 0:
+                familias = set(result.stdout.splitlines())
+                fontes['fc_list'] = True
+                fontes['familias'] = len(familias)
+                for nome in ('DejaVu Sans', 'Liberation Sans', 'Arial'):
+                    fontes[nome] = any(nome in familia for familia in familias)
+            else:
+                fontes['erro'] = 'Não foi possível verificar fontes'
+        except Exception as e:
+            fontes['erro'] = str(e)
+        _fontes = fontes
+    return _fontes
+
+# SVG mínimo com o texto dos templates, usado para aquecer fontconfig/cairo nos workers
+SVG_AQUECIMENTO = (
+    '<svg xmlns="http://www.w3.org/2000/svg" viewBox="0 0 10 10">'
+    '<text x="0" y="5" style="font-size: 10px; font-family: DejaVu Sans, Liberation Sans, Arial, sans-serif;">'
+    'Olá <tspan style="font-weight: 700;">ICCID</tspan></text></svg>'
+)
+
+def aquecer_renderizador():
+    """
+    Inicializador dos processos do pool: a primeira renderização carrega a
+    configuração do fontconfig e as fontes, que ficam em memória para as cartas seguintes
+    """
+    try:
+        svg2pdf(bytestring=SVG_AQUECIMENTO.encode('utf-8'))
+    except Exception as e:
+        logger.warning('Erro ao aquecer renderizador: %s', e)
+
+class _CartaGravada(PDFSurface):
+    """
+    Desenha o SVG de uma carta numa RecordingSurface (mesmas unidades do PDFSurface
+    do cairosvg), para depois ser reproduzido como página de um PDF compartilhado
+    """
+
+    def _create_surface(self, width, height):
+        superficie = cairocffi.RecordingSurface(cairocffi.CONTENT_COLOR_ALPHA, (0, 0, width, height))
+        return superficie, width, height
+
+def renderizar_lote(indice_lote, cartas, separar_paginas=False):
+    """
+    Renderiza um lote de cartas (indice, cliente_nome, svg) num único PDF de várias
+    páginas, usando uma só superfície cairo: as fontes são embutidas uma vez por lote.
+    Cada carta é gravada antes de virar página, então uma carta com erro não deixa
+    página parcial. Retorna também o tempo de renderização de cada carta e, com
+    separar_paginas, um PDF de uma página por carta (para o cache de cartas).
+    Executado nos processos do pool de renderização.
+    """
+    saida = io.BytesIO()
+    superficie = cairocffi.PDFSurface(saida, 1, 1)
+    contexto = cairocffi.Context(superficie)
+    renderizadas = []
+    erros = []
+    duracoes = []
+    
+    for indice, cliente_nome, svg_content in cartas:
+        inicio = time.perf_counter()
+        try:
+            carta = _CartaGravada(Tree(bytestring=svg_content.encode('utf-8')), None, 96)
+        except Exception as e:
+            erros.append((indice, cliente_nome, str(e)))
+            continue
+        
+        superficie.set_size(carta.width, carta.height)
+        contexto.set_source_surface(carta.cairo, 0, 0)
+        contexto.paint()
+        contexto.show_page()
+        renderizadas.append(indice)
+        duracoes.append(time.perf_counter() - inicio)
+    
+    superficie.finish()
+    pdf_bytes = saida.getvalue() if renderizadas else None
+    
+    paginas = []
+    if separar_paginas and pdf_bytes:
+        for pagina in PdfReader(io.BytesIO(pdf_bytes)).pages:
+            writer = PdfWriter()
+            writer.add_page(pagina)
+            buffer = io.BytesIO()
+            writer.write(buffer)
+            paginas.append(buffer.getvalue())
+    
+    return indice_lote, pdf_bytes, renderizadas, erros, duracoes, paginas
+
+def agrupar_em_lotes(cartas, tamanho_lote):
+    """
+    Agrupa as cartas (indice, cliente_nome, svg) em lotes, sem separar as
+    cartas de um mesmo cliente
+    """
+    lote = []
+    cliente_anterior = None
+    for indice, cliente_nome, svg_content in cartas:
+        if lote and cliente_nome != cliente_anterior and len(lote) >= tamanho_lote:
+            yield lote
+            lote = []
+        lote.append((indice, cliente_nome, svg_content))
+        cliente_anterior = cliente_nome
+    if lote:
+        yield lote
+
+def chave_cache_carta(hash_template, cliente_nome, grupo):
+    """Chave do cache de cartas: hash do template, cliente e pares NUMERO/ICCID"""
+    conteudo = json.dumps([hash_template, str(cliente_nome), [[item['numero'], item['iccid']] for item in grupo]])
+    return hashlib.sha256(conteudo.encode('utf-8')).hexdigest()
+
+def _caminho_cache_carta(chave):
+    return os.path.join(CACHE_FOLDER, f'carta_{chave}.pdf')
+
+def buscar_cache_carta(chave, pasta_job):
+    """
+    Fixa o PDF em cache da carta para o job e devolve o caminho fixado, ou None.
+    A entrada é ligada (hard link) em pasta_job: a limpeza do cache, deste ou de
+    outro job, pode removê-la do cache, mas a página do job continua até a mesclagem.
+    """
+    caminho = _caminho_cache_carta(chave)
+    destino = os.path.join(pasta_job, os.path.basename(caminho))
+    try:
+        os.utime(caminho)  # usada recentemente (LRU pelo mtime)
+        os.link(caminho, destino)
+    except FileExistsError:
+        pass  # mesma carta repetida no job
+    except FileNotFoundError:
+        return None
+    except OSError:
+        # Sistema de arquivos sem hard links entre as pastas: copiar
+        try:
+            shutil.copyfile(caminho, destino)
+        except FileNotFoundError:
+            return None
+    return destino
+
+def gravar_cache_carta(chave, pdf_bytes):
+    caminho = _caminho_cache_carta(chave)
+    temporario = f'{caminho}.{uuid.uuid4().hex}.tmp'
+    with open(temporario, 'wb') as f:
+        f.write(pdf_bytes)
+    os.replace(temporario, caminho)
+
+class BuffersPDF:
+    """
+    Guarda os PDFs dos lotes em memória até PDF_SPILL_BYTES; a partir daí cada PDF
+    vai para um arquivo em `pasta`, mantendo a memória limitada. Cada entrada é
+    bytes ou o caminho do arquivo, e pode ser enviada ao pool de CPU (fonte_pdf).
+    """
+
+    def __init__(self, limite_memoria, pasta):
+        self.limite_memoria = limite_memoria
+        self.pasta = pasta
+        self.bytes_em_memoria = 0
+        self.buffers = []
+
+    def adicionar(self, pdf_bytes):
+        if self.limite_memoria and self.bytes_em_memoria + len(pdf_bytes) > self.limite_memoria:
+            buffer = os.path.join(self.pasta, f'lote_{len(self.buffers):05d}.pdf')
+            with open(buffer, 'wb') as f:
+                f.write(pdf_bytes)
+        else:
+            buffer = pdf_bytes
+            self.bytes_em_memoria += len(pdf_bytes)
+        self.buffers.append(buffer)
+        return buffer
+
+    def __len__(self):
+        return len(self.buffers)
+
+    def __getitem__(self, indice):
+        return self.buffers[indice]
+
+    def fechar(self):
+        for buffer in self.buffers:
+            if isinstance(buffer, str) and os.path.exists(buffer):
+                os.remove(buffer)
+        self.buffers = []
+        self.bytes_em_memoria = 0
+
+# Pool de processos para renderização SVG -> PDF (criado sob demanda)
+_executor_render = None
+_executor_render_lock = threading.Lock()
+
+def obter_executor_render():
+    """Retorna o pool de renderização, dimensionado por MAX_WORKERS"""
+    global _executor_render
+    with _executor_render_lock:
+        if _executor_render is None:
+            # spawn evita herdar threads e estado do cairo/fontconfig do processo Flask
+            _executor_render = ProcessPoolExecutor(
+                max_workers=app.config['MAX_WORKERS'],
+                mp_context=multiprocessing.get_context('spawn'),
+                initializer=aquecer_renderizador
+            )
+        return _executor_render
+
+def renderizar_em_paralelo(funcao, tarefas):
+    """
+    Executa funcao(*args) no pool para cada tarefa e devolve os resultados na
+    ordem original das tarefas. Mantém no máximo MAX_WORKERS * 4 tarefas em voo.
+    """
+    global _executor_render
+    executor = obter_executor_render()
+    janela = app.config['MAX_WORKERS'] * 4
+    pendentes = deque()
+    try:
+        for args in tarefas:
+            pendentes.append(executor.submit(funcao, *args))
+            if len(pendentes) >= janela:
+                yield pendentes.popleft().result()
+        while pendentes:
+            yield pendentes.popleft().result()
+    except BrokenProcessPool:
+        # Um processo morreu (ex.: falta de memória): descartar o pool para o próximo job
+        with _executor_render_lock:
+            if _executor_render is executor:
+                _executor_render = None
+        raise
+    finally:
+        for futuro in pendentes:
+            futuro.cancel()
+
+# Montagem de PDFs: o PyPDF2 é Python puro e seguraria o GIL do processo web durante
+# segundos num job grande, então a montagem roda no pool de CPU. O job thread só
+# descreve o documento (fontes e páginas) e espera.
+
+def gravar_paginas_pdf(fontes, paginas, output_path):
+    """
+    Grava em output_path as páginas (índice da fonte, página) na ordem dada; com
+    paginas None, todas as páginas de todas as fontes. Cada fonte (bytes de um PDF ou
+    caminho) é lida uma única vez, então recursos compartilhados (fontes tipográficas)
+    das páginas de um lote não são duplicados. Retorna a quantidade de páginas.
+    """
+    leitores = [PdfReader(io.BytesIO(fonte) if isinstance(fonte, bytes) else fonte) for fonte in fontes]
+    writer = PdfWriter()
+    if paginas is None:
+        paginas = [(indice, pagina) for indice, leitor in enumerate(leitores) for pagina in range(len(leitor.pages))]
+    for indice, pagina in paginas:
+        writer.add_page(leitores[indice].pages[pagina])
+    with open(output_path, 'wb') as f:
+        writer.write(f)
+    return len(writer.pages)
+
+def plano_de_paginas(paginas_saida, pagina_no_lote, pdf_buffers):
+    """
+    Fontes e páginas de gravar_paginas_pdf para um trecho de paginas_saida: cartas do
+    cache (uma página cada) e páginas dos lotes; cartas com erro não têm página.
+    """
+    fontes = []
+    indices = {}
+    paginas = []
+    
+    def indice_da_fonte(chave, fonte):
+        if chave not in indices:
+            indices[chave] = len(fontes)
+            fontes.append(fonte)
+        return indices[chave]
+    
+    for origem, valor, _ in paginas_saida:
+        if origem == 'cache':
+            paginas.append((indice_da_fonte(('cache', valor), valor), 0))
+        elif valor in pagina_no_lote:
+            indice_lote, pagina = pagina_no_lote[valor]
+            paginas.append((indice_da_fonte(('lote', indice_lote), pdf_buffers[indice_lote]), pagina))
+    return fontes, paginas
+
+def montar_pdf_com_cache(paginas_saida, pagina_no_lote, pdf_buffers, output_path):
+    """Grava o PDF final na ordem de paginas_saida, intercalando cartas do cache e dos lotes"""
+    fontes, paginas = plano_de_paginas(paginas_saida, pagina_no_lote, pdf_buffers)
+    return executar_no_pool_cpu(gravar_paginas_pdf, fontes, paginas, output_path)
+
+def pasta_partes(job_id):
+    return os.path.join(TEMP_FOLDER, f'partes_{job_id}')
+
+class EntregaEmPartes:
+    """
+    Grava partes numeradas do PDF final (parte_0001.pdf, ...) assim que um trecho
+    contínuo de paginas_saida fica pronto. Uma parte só termina na fronteira entre
+    clientes, então cada cliente sai inteiro numa única parte.
+    """
+
+    def __init__(self, job_id):
+        self.job_id = job_id
+        self.pasta = pasta_partes(job_id)
+        os.makedirs(self.pasta, exist_ok=True)
+        self.proxima = 0  # primeira entrada de paginas_saida ainda não entregue
+        self.partes = []
+
+    def emitir(self, paginas_saida, resolvidas, pagina_no_lote, pdf_buffers, final=False):
+        """
+        Grava a próxima parte, se houver clientes completos. Retorna o manifesto
+        da parte gravada ou None.
+        """
+        corte = None
+        fim = self.proxima
+        while fim < len(paginas_saida):
+            origem, valor, cliente = paginas_saida[fim]
+            if origem == 'lote' and valor not in resolvidas:
+                break
+            fim += 1
+            if fim < len(paginas_saida):
+                if paginas_saida[fim][2] != cliente:
+                    corte = fim
+            elif final:
+                corte = fim
+        if corte is None:
+            return None
+        
+        trecho = paginas_saida[self.proxima:corte]
+        self.proxima = corte
+        fontes, paginas = plano_de_paginas(trecho, pagina_no_lote, pdf_buffers)
+        if not paginas:
+            return None
+        
+        numero = len(self.partes) + 1
+        caminho = os.path.join(self.pasta, f'parte_{numero:04d}.pdf')
+        executar_no_pool_cpu(gravar_paginas_pdf, fontes, paginas, caminho + '.tmp')
+        os.replace(caminho + '.tmp', caminho)  # a parte só aparece completa
+        parte = {
+            'numero': numero,
+            'url': f'/api/download/{self.job_id}/parte/{numero}',
+            'paginas': len(paginas),
+            'primeiro_cliente': str(trecho[0][2]),
+            'ultimo_cliente': str(trecho[-1][2]),
+            'bytes': os.path.getsize(caminho),
+        }
+        self.partes.append(parte)
+        return parte
+
+@contextmanager
+def medir_etapa(job_id, etapa):
+    """Acumula em jobs[job_id]['tempos'] o tempo (segundos) gasto numa etapa do job"""
+    inicio = time.perf_counter()
+    try:
+        yield
+    finally:
+        duracao = time.perf_counter() - inicio
+        tempos = jobs[job_id].setdefault('tempos', {})
+        tempos[etapa] = round(tempos.get(etapa, 0) + duracao, 3)
+        metricas.observar('cartas_etapa_duracao_segundos', duracao, etapa=etapa)
+
+def renderizar_planilha(job_id, excel_file, coluna_cliente, coluna_numero, coluna_iccid, output_path,
+                        partes=None, cartas_antes=0, cartas_total=None, rotulo='', max_por_carta=6,
+                        cartas_planilha=None):
+    """
+    Lê uma planilha, renderiza suas cartas por cliente e grava o PDF em output_path,
+    atualizando o progresso em jobs[job_id]. Em jobs com várias planilhas,
+    cartas_antes e cartas_total situam esta planilha no progresso do job e
+    cartas_planilha traz a contagem já feita, que então não é refeita.
+    max_por_carta vem de numeros_por_carta (6, ou mais no modo de empacotamento).
+    Retorna (total_cartas, cartas_do_cache, cartas_com_erro).
+    """
+    log = logger_job(job_id)
+    
+    # Ler do cache colunar apenas as colunas usadas
+    excel_path = os.path.join(UPLOAD_FOLDER, excel_file)
+    with medir_etapa(job_id, 'leitura_excel'):
+        _, colunas = ler_colunas_planilha(excel_path, [coluna_cliente, coluna_numero, coluna_iccid])
+    
+    # Agrupar por cliente
+    with medir_etapa(job_id, 'agrupamento'):
+        clientes = agrupar_por_cliente(linhas_de_colunas(colunas), coluna_cliente)
+        del colunas
+    
+    log.info('%s: %d clientes em ordem das linhas do Excel', excel_file, len(clientes))
+    if log.isEnabledFor(logging.DEBUG):
+        for i, cliente in enumerate(clientes, 1):
+            log.debug('  %d. %s', i, cliente)
+    
+    # Pré-contagem exata das cartas (sem renderizar) para progresso e ETA
+    if cartas_planilha is None:
+        with medir_etapa(job_id, 'contagem'):
+            cartas_por_quantidade = contar_cartas(clientes, coluna_numero, coluna_iccid, max_por_carta)
+            total_previsto = total_de_cartas(cartas_por_quantidade)
+        log.info('%d cartas previstas (por quantidade de números: %s)', total_previsto, cartas_por_quantidade)
+    else:
+        total_previsto = cartas_planilha
+    
+    if cartas_total is None:
+        cartas_total = total_previsto
+        jobs[job_id]['progress'] = 10
+        jobs[job_id]['cartas_processadas'] = 0
+        jobs[job_id]['cartas_total'] = total_previsto
+        jobs[job_id]['cartas_por_quantidade'] = {str(q): cartas for q, cartas in cartas_por_quantidade.items()}
+    jobs[job_id]['message'] = f'{rotulo}Processando {len(clientes)} clientes em ordem das linhas do Excel...'
+    salvar_job(job_id)
+    
+    # Tamanho do lote: até CARTAS_POR_LOTE, mas pequeno o bastante para ocupar todos os workers
+    tamanho_lote = max(1, min(app.config['CARTAS_POR_LOTE'],
+                              math.ceil(total_previsto / (app.config['MAX_WORKERS'] * 2))))
+    
+    # Cache de cartas: cartas já renderizadas antes (mesmo template e mesmos dados) são reaproveitadas.
+    # Os acertos ficam fixados em pasta_cartas até o fim da planilha, junto com os lotes
+    # que não couberem em PDF_SPILL_BYTES.
+    cache_cartas = app.config['RENDER_CACHE_MAX_BYTES'] > 0
+    pasta_cartas = tempfile.mkdtemp(prefix=f'cartas_{job_id}_', dir=TEMP_FOLDER)
+    hashes_templates = {}
+    chaves_cache = {}  # indice da carta -> chave no cache
+    # Ordem final das páginas: ('cache', caminho, cliente) ou ('lote', indice da carta, cliente)
+    paginas_saida = []
+    pagina_no_lote = {}  # indice da carta -> (indice do lote, página no lote)
+    resolvidas = set()  # indices das cartas já renderizadas ou com erro
+    acertos_cache = [0]
+    
+    def cartas_a_renderizar():
+        for indice, (cliente_nome, grupo, template_file, svg_modificado) in enumerate(
+                gerar_cartas(clientes, coluna_numero, coluna_iccid, log, max_por_carta)):
+            if cache_cartas:
+                if template_file not in hashes_templates:
+                    hashes_templates[template_file] = carregar_template(template_file).hash_origem
+                chave = chave_cache_carta(hashes_templates[template_file], cliente_nome, grupo)
+                caminho = buscar_cache_carta(chave, pasta_cartas)
+                if caminho:
+                    paginas_saida.append(('cache', caminho, cliente_nome))
+                    acertos_cache[0] += 1
+                    continue
+                chaves_cache[indice] = chave
+            paginas_saida.append(('lote', indice, cliente_nome))
+            yield indice, cliente_nome, svg_modificado
+    
+    def tarefas():
+        # Enviar cada lote de cartas para renderização no pool, sem passar pelo disco
+        for indice_lote, lote in enumerate(agrupar_em_lotes(cartas_a_renderizar(), tamanho_lote)):
+            yield indice_lote, lote, cache_cartas
+    
+    # PDFs de cada lote (na ordem original dos clientes)
+    pdf_buffers = BuffersPDF(app.config['PDF_SPILL_BYTES'], pasta_cartas)
+    total_cartas = 0
+    cartas_com_erro = 0
+    
+    def emitir_partes(final=False):
+        parte = partes.emitir(paginas_saida, resolvidas, pagina_no_lote, pdf_buffers, final)
+        if parte:
+            log.info('Parte %d disponível: %d páginas (%s .. %s)', parte['numero'], parte['paginas'],
+                     parte['primeiro_cliente'], parte['ultimo_cliente'])
+            salvar_job(job_id, intervalo=0)  # outros workers do gunicorn já podem servir a parte
+    
+    try:
+        with medir_etapa(job_id, 'renderizacao'):
+            inicio_renderizacao = time.perf_counter()
+            resultados = renderizar_em_paralelo(renderizar_lote, tarefas())
+            for indice_lote, pdf_bytes, renderizadas, erros, duracoes, paginas in resultados:
+                for indice, cliente_nome, erro in erros:
+                    resolvidas.add(indice)
+                    log.error('Erro ao converter SVG para PDF (carta %d, cliente %s): %s', indice, cliente_nome, erro)
+                cartas_com_erro += len(erros)
+                metricas.incrementar('cartas_com_erro_total', len(erros))
+                metricas.incrementar('cartas_renderizadas_total', len(renderizadas))
+                for duracao in duracoes:
+                    metricas.observar('cartas_carta_renderizacao_segundos', duracao)
+                
+                if pdf_bytes:
+                    pdf_buffers.adicionar(pdf_bytes)
+                for pagina, indice in enumerate(renderizadas):
+                    pagina_no_lote[indice] = (len(pdf_buffers) - 1, pagina)
+                resolvidas.update(renderizadas)
+                
+                # Guardar cada carta renderizada no cache
+                for indice, pagina_bytes in zip(renderizadas, paginas):
+                    gravar_cache_carta(chaves_cache.pop(indice), pagina_bytes)
+                
+                total_cartas += len(renderizadas)
+                log.debug('Lote %d renderizado: %d cartas', indice_lote, len(renderizadas))
+                
+                # Atualizar progresso (cartas do cache contam como processadas)
+                processadas = cartas_antes + total_cartas + cartas_com_erro + acertos_cache[0]
+                progress = 10 + int((processadas / max(cartas_total, 1)) * 80)
+                jobs[job_id]['progress'] = min(progress, 90)
+                # Vazão considera só cartas renderizadas; as do cache não custam tempo
+                decorrido = time.perf_counter() - inicio_renderizacao
+                por_segundo = (total_cartas + cartas_com_erro) / decorrido if decorrido > 0 else 0
+                jobs[job_id]['cartas_processadas'] = processadas
+                jobs[job_id]['cartas_por_segundo'] = round(por_segundo, 1)
+                jobs[job_id]['eta_segundos'] = (
+                    round(max(cartas_total - processadas, 0) / por_segundo)
+                    if por_segundo else None
+                )
+                jobs[job_id]['message'] = f'{rotulo}Processado lote {indice_lote + 1} ({total_cartas} cartas)'
+                if partes:
+                    emitir_partes()
+                salvar_job(job_id)
+            
+            if partes:
+                emitir_partes(final=True)
+                jobs[job_id]['partes_completas'] = True
+        
+        cartas_do_cache = acertos_cache[0]
+        total_cartas = cartas_do_cache + len(pagina_no_lote)
+        metricas.incrementar('cartas_cache_acertos_total', cartas_do_cache)
         
-        # Mesclar PDFs
-        jobs[job_id]['message'] = 'Mesclando PDFs...'
-        merger = PdfMerger()
+        with medir_etapa(job_id, 'mesclagem'):
+            if cartas_do_cache:
+                # Montar o PDF final na ordem original, intercalando cartas do cache e páginas dos lotes
+                jobs[job_id]['message'] = f'{rotulo}Mesclando PDFs...'
+                salvar_job(job_id)
+                montar_pdf_com_cache(paginas_saida, pagina_no_lote, pdf_buffers, output_path)
+            elif len(pdf_buffers) == 1:
+                # Um único lote já é o documento final
+                if isinstance(pdf_buffers[0], str):
+                    shutil.copyfile(pdf_buffers[0], output_path)
+                else:
+                    with open(output_path, 'wb') as f:
+                        f.write(pdf_buffers[0])
+            else:
+                # Mesclar os PDFs dos lotes (no pool de CPU)
+                jobs[job_id]['message'] = f'{rotulo}Mesclando PDFs...'
+                salvar_job(job_id)
+                executar_no_pool_cpu(gravar_paginas_pdf, pdf_buffers.buffers, None, output_path)
         
-        for pdf_file in pdf_files:
-            merger.append(pdf_file)
+        # Limite do cache aplicado uma vez por planilha; as páginas deste job já estão fixadas
+        if cache_cartas and total_cartas > cartas_do_cache:
+            limitar_cache('carta_', app.config['RENDER_CACHE_MAX_BYTES'])
+    finally:
+        # Liberar buffers e arquivos temporários
+        with medir_etapa(job_id, 'limpeza'):
+            pdf_buffers.fechar()
+            remover_caminho(pasta_cartas)
+    
+    return total_cartas, cartas_do_cache, cartas_com_erro
+
+def concluir_job(job_id, total_cartas, cartas_do_cache, cartas_com_erro, output_path):
+    """Marca o job como concluído, com o resumo das cartas geradas"""
+    jobs[job_id]['status'] = 'completed'
+    jobs[job_id]['progress'] = 100
+    jobs[job_id]['eta_segundos'] = 0
+    jobs[job_id]['message'] = f'PDFs gerados com sucesso! Total: {total_cartas} cartas'
+    if cartas_do_cache:
+        jobs[job_id]['message'] += f' ({cartas_do_cache} reaproveitadas do cache)'
+    if cartas_com_erro:
+        jobs[job_id]['message'] += f' ({cartas_com_erro} com erro)'
+    jobs[job_id]['cartas_do_cache'] = cartas_do_cache
+    jobs[job_id]['cartas_com_erro'] = cartas_com_erro
+    jobs[job_id]['download_url'] = f'/api/download/{job_id}'
+    metricas.incrementar('cartas_pdf_saida_bytes_total', os.path.getsize(output_path))
+
+def registrar_fim_job(job_id, inicio_job, log):
+    """Grava o tempo total, persiste o estado final e registra métricas e log"""
+    jobs[job_id]['finalizado_em'] = time.time()
+    tempos = jobs[job_id]['tempos']
+    tempos['total'] = round(time.perf_counter() - inicio_job, 3)
+    salvar_job(job_id)
+    metricas.observar('cartas_job_duracao_segundos', tempos['total'])
+    metricas.incrementar('cartas_jobs_finalizados_total', status=jobs[job_id]['status'])
+    log.info('Job finalizado (%s): %s', jobs[job_id]['status'],
+             ', '.join(f'{etapa}={segundos:.3f}s' for etapa, segundos in tempos.items()))
+
+def process_pdf_generation_por_cliente(job_id, excel_file, coluna_cliente, coluna_numero, coluna_iccid,
+                                       entrega_em_partes=False, empacotar=False):
+    log = logger_job(job_id)
+    inicio_job = time.perf_counter()
+    try:
+        jobs[job_id] = {'status': 'processing', 'progress': 0, 'message': 'Iniciando processamento por cliente...', 'tempos': {}}
+        salvar_job(job_id)
+        log.info('Job iniciado: %s (cliente=%s, numero=%s, iccid=%s)', excel_file, coluna_cliente, coluna_numero, coluna_iccid)
         
-        # Salvar PDF final
         output_path = os.path.join(TEMP_FOLDER, f'output_cliente_{job_id}.pdf')
-        merger.write(output_path)
-        merger.close()
         
-        # Limpar arquivos temporários
-        for pdf_file in pdf_files:
-            try:
-                os.remove(pdf_file)
-            except:
-                pass
+        # Entrega em partes: clientes completos ficam disponíveis para download durante o job
+        partes = EntregaEmPartes(job_id) if entrega_em_partes else None
+        if partes:
+            jobs[job_id]['partes'] = partes.partes
+            jobs[job_id]['partes_completas'] = False
         
-        jobs[job_id]['status'] = 'completed'
-        jobs[job_id]['progress'] = 100
-        jobs[job_id]['message'] = f'PDFs gerados com sucesso! Total: {total_cartas} cartas'
-        jobs[job_id]['download_url'] = f'/api/download/{job_id}'
+        total_cartas, cartas_do_cache, cartas_com_erro = renderizar_planilha(
+            job_id, excel_file, coluna_cliente, coluna_numero, coluna_iccid, output_path, partes=partes,
+            max_por_carta=numeros_por_carta(empacotar)
+        )
+        concluir_job(job_id, total_cartas, cartas_do_cache, cartas_com_erro, output_path)
+    
+    except Exception as e:
+        log.exception('Erro no job')
+        jobs[job_id]['status'] = 'error'
+        jobs[job_id]['message'] = f'Erro: {str(e)}'
+    
+    registrar_fim_job(job_id, inicio_job, log)
+
+def process_pdf_generation_lote(job_id, planilhas, saida='pdf', empacotar=False):
+    """
+    Processa várias planilhas num único job, cada uma com seu mapeamento de colunas.
+    Templates compilados e o pool de renderização já aquecido são compartilhados.
+    Gera um PDF combinado (saida='pdf') ou um ZIP com um PDF por planilha (saida='zip').
+    """
+    log = logger_job(job_id)
+    inicio_job = time.perf_counter()
+    output_path = os.path.join(TEMP_FOLDER, f'output_lote_{job_id}.{saida}')
+    pdfs_planilhas = []
+    max_por_carta = numeros_por_carta(empacotar)
+    try:
+        jobs[job_id] = {'status': 'processing', 'progress': 0, 'message': f'Iniciando lote de {len(planilhas)} planilhas...', 'tempos': {}}
+        salvar_job(job_id)
+        log.info('Job em lote iniciado: %s (saída %s)', ', '.join(p['excel_file'] for p in planilhas), saida)
+        
+        # Pré-contagem de todas as planilhas, para o progresso do lote inteiro
+        totais = []
+        cartas_por_quantidade = defaultdict(int)
+        with medir_etapa(job_id, 'contagem'):
+            for planilha in planilhas:
+                excel_path = os.path.join(UPLOAD_FOLDER, planilha['excel_file'])
+                _, colunas = ler_colunas_planilha(excel_path, [planilha['coluna_cliente'], planilha['coluna_numero'],
+                                                               planilha['coluna_iccid']])
+                clientes = agrupar_por_cliente(linhas_de_colunas(colunas), planilha['coluna_cliente'])
+                contagem = contar_cartas(clientes, planilha['coluna_numero'], planilha['coluna_iccid'], max_por_carta)
+                totais.append(total_de_cartas(contagem))
+                log.info('%s: %d cartas previstas (por quantidade de números: %s)',
+                         planilha['excel_file'], totais[-1], contagem)
+                for quantidade, cartas in contagem.items():
+                    cartas_por_quantidade[quantidade] += cartas
+                del colunas, clientes
+        
+        jobs[job_id]['progress'] = 10
+        jobs[job_id]['cartas_processadas'] = 0
+        jobs[job_id]['cartas_total'] = sum(totais)
+        jobs[job_id]['cartas_por_quantidade'] = {str(q): cartas for q, cartas in sorted(cartas_por_quantidade.items())}
+        salvar_job(job_id)
         
+        total_cartas = cartas_do_cache = cartas_com_erro = 0
+        arquivo_zip = zipfile.ZipFile(output_path, 'w', zipfile.ZIP_STORED) if saida == 'zip' else None
+        try:
+            for i, planilha in enumerate(planilhas):
+                pdf_planilha = os.path.join(TEMP_FOLDER, f'lote_{job_id}_{i:03d}.pdf')
+                pdfs_planilhas.append(pdf_planilha)
+                resultado = renderizar_planilha(
+                    job_id, planilha['excel_file'], planilha['coluna_cliente'], planilha['coluna_numero'],
+                    planilha['coluna_iccid'], pdf_planilha, cartas_antes=sum(totais[:i]),
+                    cartas_total=jobs[job_id]['cartas_total'], rotulo=f'Planilha {i + 1}/{len(planilhas)}: ',
+                    max_por_carta=max_por_carta, cartas_planilha=totais[i]
+                )
+                total_cartas += resultado[0]
+                cartas_do_cache += resultado[1]
+                cartas_com_erro += resultado[2]
+                
+                if arquivo_zip:
+                    # PDFs já são comprimidos; o ZIP só os armazena, copiando do disco em blocos
+                    with medir_etapa(job_id, 'compactacao'):
+                        nome = os.path.splitext(planilha['excel_file'])[0]
+                        arquivo_zip.write(pdf_planilha, f'{i + 1:02d}_{nome}.pdf')
+                        os.remove(pdf_planilha)
+        finally:
+            if arquivo_zip:
+                arquivo_zip.close()
+        
+        if not arquivo_zip:
+            with medir_etapa(job_id, 'mesclagem'):
+                jobs[job_id]['message'] = 'Combinando PDFs das planilhas...'
+                salvar_job(job_id)
+                executar_no_pool_cpu(gravar_paginas_pdf, pdfs_planilhas, None, output_path)
+        
+        concluir_job(job_id, total_cartas, cartas_do_cache, cartas_com_erro, output_path)
+        jobs[job_id]['message'] += f' em {len(planilhas)} planilhas'
+    
+    except Exception as e:
+        log.exception('Erro no job')
+        jobs[job_id]['status'] = 'error'
+        jobs[job_id]['message'] = f'Erro: {str(e)}'
+    finally:
+        for pdf_planilha in pdfs_planilhas:
+            if os.path.exists(pdf_planilha):
+                os.remove(pdf_planilha)
+    
+    registrar_fim_job(job_id, inicio_job, log)
+
+# Fila de jobs persistente
+#
+# Os jobs ficam numa tabela SQLite (JOBS_DB), então o estado sobrevive a restarts e é
+# visível para todos os workers do gunicorn. Cada processo roda um agendador que
+# reivindica jobs da fila (prioridade maior primeiro, depois FIFO) enquanto houver
+# menos de MAX_JOBS_SIMULTANEOS em processamento. Jobs em processamento sem heartbeat
+# há mais de JOB_HEARTBEAT_TIMEOUT segundos (ex.: worker reiniciado) voltam para a fila.
+
+ESTADO_NA_FILA = {'status': 'queued', 'progress': 0, 'message': 'Aguardando na fila...'}
+ESTADO_INICIANDO = {'status': 'processing', 'progress': 0, 'message': 'Iniciando processamento...'}
+
+# Identificação deste processo nos jobs que ele reivindica
+# Token deste processo: um container reiniciado mantém o hostname e costuma repetir
+# os PIDs, e sem o token o novo processo assumiria os jobs órfãos do anterior
+_TOKEN_PROCESSO = uuid.uuid4().hex
+
+def _id_worker():
+    return f'{socket.gethostname()}:{os.getpid()}:{_TOKEN_PROCESSO}'
+
+def _processo_vivo(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+_jobs_db_inicializado = False
+
+def _conexao_jobs():
+    """Abre uma conexão com JOBS_DB (autocommit; transações explícitas com BEGIN IMMEDIATE)"""
+    global _jobs_db_inicializado
+    conexao = sqlite3.connect(app.config['JOBS_DB'], timeout=30, isolation_level=None)
+    conexao.row_factory = sqlite3.Row
+    if not _jobs_db_inicializado:
+        conexao.execute('PRAGMA journal_mode=WAL')
+        conexao.execute("""
+            CREATE TABLE IF NOT EXISTS jobs (
+                job_id TEXT PRIMARY KEY,
+                status TEXT NOT NULL,
+                prioridade INTEGER NOT NULL DEFAULT 0,
+                criado_em REAL NOT NULL,
+                atualizado_em REAL NOT NULL,
+                worker TEXT,
+                params TEXT NOT NULL,
+                estado TEXT NOT NULL
+            )
+        """)
+        conexao.execute('CREATE INDEX IF NOT EXISTS jobs_fila ON jobs (status, prioridade DESC, criado_em)')
+        _jobs_db_inicializado = True
+    return conexao
+
+def enfileirar_job(job_id, params, prioridade=0):
+    """
+    Coloca o job na fila. Retorna a posição na fila, ou None se a fila
+    já tiver FILA_MAX jobs aguardando.
+    """
+    agora = time.time()
+    with closing(_conexao_jobs()) as conexao:
+        conexao.execute('BEGIN IMMEDIATE')
+        try:
+            na_fila = conexao.execute("SELECT COUNT(*) FROM jobs WHERE status = 'queued'").fetchone()[0]
+            if na_fila >= app.config['FILA_MAX']:
+                conexao.execute('ROLLBACK')
+                return None
+            conexao.execute(
+                'INSERT INTO jobs (job_id, status, prioridade, criado_em, atualizado_em, params, estado) '
+                "VALUES (?, 'queued', ?, ?, ?, ?, ?)",
+                (job_id, prioridade, agora, agora, json.dumps(params), json.dumps(ESTADO_NA_FILA))
+            )
+            conexao.execute('COMMIT')
+        except Exception:
+            conexao.execute('ROLLBACK')
+            raise
+    
+    iniciar_agendador()
+    return posicao_na_fila(job_id)
+
+def posicao_na_fila(job_id):
+    """Posição (1 = próximo) de um job aguardando na fila, ou None"""
+    with closing(_conexao_jobs()) as conexao:
+        job = conexao.execute(
+            "SELECT prioridade, criado_em FROM jobs WHERE job_id = ? AND status = 'queued'", (job_id,)
+        ).fetchone()
+        if job is None:
+            return None
+        return conexao.execute(
+            "SELECT COUNT(*) FROM jobs WHERE status = 'queued' "
+            'AND (prioridade > ? OR (prioridade = ? AND criado_em <= ?))',
+            (job['prioridade'], job['prioridade'], job['criado_em'])
+        ).fetchone()[0]
+
+# Último salvamento de cada job deste processo: job_id -> (instante, status)
+_ultimo_salvamento = {}
+
+# Avisa os streams de /api/job-events deste processo que algum job mudou
+_eventos_jobs = threading.Condition()
+_versao_eventos = [0]
+_conexoes_sse = [0]
+
+def notificar_job():
+    with _eventos_jobs:
+        _versao_eventos[0] += 1
+        _eventos_jobs.notify_all()
+
+def salvar_job(job_id, intervalo=0.5):
+    """
+    Persiste jobs[job_id] em JOBS_DB. Atualizações de progresso são gravadas no
+    máximo a cada `intervalo` segundos; mudanças de status são sempre gravadas.
+    """
+    notificar_job()
+    estado = jobs[job_id]
+    agora = time.time()
+    ultimo = _ultimo_salvamento.get(job_id)
+    if ultimo and ultimo[1] == estado['status'] and agora - ultimo[0] < intervalo:
+        return
+    
+    with closing(_conexao_jobs()) as conexao:
+        conexao.execute(
+            'UPDATE jobs SET status = ?, estado = ?, atualizado_em = ? WHERE job_id = ?',
+            (estado['status'], json.dumps(estado), agora, job_id)
+        )
+    _ultimo_salvamento[job_id] = (agora, estado['status'])
+
+def serializar_job(job):
+    """JSON do estado do job; lê de novo se a thread do job o alterar durante a leitura"""
+    while True:
+        try:
+            return json.dumps(job)
+        except RuntimeError:
+            continue
+
+def obter_job(job_id):
+    """Estado do job: da memória se roda neste processo, senão de JOBS_DB"""
+    if job_id in jobs:
+        return jobs[job_id]
+    
+    with closing(_conexao_jobs()) as conexao:
+        job = conexao.execute('SELECT status, estado FROM jobs WHERE job_id = ?', (job_id,)).fetchone()
+    if job is None:
+        return None
+    
+    estado = json.loads(job['estado'])
+    if job['status'] == 'queued':
+        posicao = posicao_na_fila(job_id)
+        estado['status'] = 'queued'
+        estado['posicao'] = posicao
+        estado['message'] = f'Aguardando na fila (posição {posicao})...'
+    return estado
+
+def _reivindicar_proximo_job():
+    """Marca o próximo job da fila como em processamento por este processo, se houver capacidade"""
+    with closing(_conexao_jobs()) as conexao:
+        conexao.execute('BEGIN IMMEDIATE')
+        try:
+            em_processamento = conexao.execute(
+                "SELECT COUNT(*) FROM jobs WHERE status = 'processing'"
+            ).fetchone()[0]
+            job = None
+            if em_processamento < app.config['MAX_JOBS_SIMULTANEOS']:
+                job = conexao.execute(
+                    "SELECT job_id, params FROM jobs WHERE status = 'queued' "
+                    'ORDER BY prioridade DESC, criado_em LIMIT 1'
+                ).fetchone()
+            if job is not None:
+                conexao.execute(
+                    "UPDATE jobs SET status = 'processing', worker = ?, atualizado_em = ?, estado = ? "
+                    'WHERE job_id = ?',
+                    (_id_worker(), time.time(), json.dumps(ESTADO_INICIANDO), job['job_id'])
+                )
+            conexao.execute('COMMIT')
+        except Exception:
+            conexao.execute('ROLLBACK')
+            raise
+    
+    if job is None:
+        return None
+    return job['job_id'], json.loads(job['params'])
+
+def _heartbeat_e_recuperacao():
+    """
+    Renova o heartbeat só dos jobs que ainda rodam neste processo e devolve à fila os
+    jobs abandonados, inclusive os deste processo cuja thread terminou sem finalizá-los
+    """
+    agora = time.time()
+    em_execucao = jobs_em_execucao()
+    with closing(_conexao_jobs()) as conexao:
+        if em_execucao:
+            conexao.execute(
+                "UPDATE jobs SET atualizado_em = ? WHERE status = 'processing' AND worker = ? "
+                f"AND job_id IN ({', '.join('?' * len(em_execucao))})",
+                (agora, _id_worker(), *em_execucao)
+            )
+        conexao.execute(
+            "UPDATE jobs SET status = 'queued', worker = NULL, estado = ? "
+            "WHERE status = 'processing' AND atualizado_em < ?",
+            (json.dumps(ESTADO_NA_FILA), agora - app.config['JOB_HEARTBEAT_TIMEOUT'])
+        )
+
+def _recuperar_jobs_do_host():
+    """
+    Na inicialização do agendador, devolve à fila sem esperar o timeout do heartbeat os
+    jobs em processamento deste host que ficaram de um boot anterior: os do mesmo PID
+    com outro token e os de PIDs que não existem mais. Workers vivos do mesmo host
+    não são afetados.
+    """
+    host = socket.gethostname()
+    with closing(_conexao_jobs()) as conexao:
+        linhas = conexao.execute(
+            "SELECT job_id, worker FROM jobs WHERE status = 'processing' AND worker LIKE ?",
+            (f'{host}:%',)
+        ).fetchall()
+        for linha in linhas:
+            if linha['worker'] == _id_worker():
+                continue
+            pid = linha['worker'][len(host) + 1:].split(':')[0]
+            if not pid.isdigit() or (int(pid) != os.getpid() and _processo_vivo(int(pid))):
+                continue
+            conexao.execute(
+                "UPDATE jobs SET status = 'queued', worker = NULL, estado = ? "
+                "WHERE job_id = ? AND status = 'processing' AND worker = ?",
+                (json.dumps(ESTADO_NA_FILA), linha['job_id'], linha['worker'])
+            )
+            logger.warning('Job %s de um boot anterior (%s) devolvido à fila', linha['job_id'], linha['worker'])
+
+def executar_job(job_id, params):
+    """Executa um job reivindicado da fila"""
+    try:
+        if params.get('tipo') == 'por_cliente':
+            process_pdf_generation_por_cliente(
+                job_id, params['excel_file'], params['coluna_cliente'],
+                params['coluna_numero'], params['coluna_iccid'],
+                entrega_em_partes=params.get('entrega_em_partes', False),
+                empacotar=params.get('empacotar', False)
+            )
+        elif params.get('tipo') == 'lote':
+            process_pdf_generation_lote(job_id, params['planilhas'], params.get('saida', 'pdf'),
+                                        empacotar=params.get('empacotar', False))
+        else:
+            jobs[job_id] = {'status': 'error', 'progress': 0, 'message': f'Tipo de job desconhecido: {params.get("tipo")}'}
+            salvar_job(job_id)
     except Exception as e:
+        logger.exception('Erro ao executar o job %s', job_id)
+        jobs.setdefault(job_id, {'progress': 0})
         jobs[job_id]['status'] = 'error'
         jobs[job_id]['message'] = f'Erro: {str(e)}'
+    finally:
+        # A thread não termina com o job em andamento: sem isso o heartbeat pararia, mas
+        # a linha só seria devolvida à fila depois do timeout
+        job = jobs.get(job_id)
+        if job is None or job['status'] not in ('completed', 'error'):
+            jobs[job_id] = {**(job or {'progress': 0}), 'status': 'error', 'message': 'Erro: job interrompido'}
+        try:
+            salvar_job(job_id)
+        except Exception:
+            logger.exception('Erro ao salvar o job %s', job_id)
+        _ultimo_salvamento.pop(job_id, None)
+
+def _agendador():
+    """Loop do agendador deste processo"""
+    ultima_limpeza = 0
+    try:
+        _recuperar_jobs_do_host()
+    except Exception:
+        logger.exception('Erro ao recuperar jobs de um boot anterior')
+    while True:
+        try:
+            _heartbeat_e_recuperacao()
+            
+            if time.time() - ultima_limpeza >= app.config['LIMPEZA_INTERVALO']:
+                ultima_limpeza = time.time()
+                limpar_arquivos()
+            
+            while True:
+                proximo = _reivindicar_proximo_job()
+                if proximo is None:
+                    break
+                threading.Thread(target=executar_job, args=proximo, daemon=True).start()
+        except Exception:
+            logger.exception('Erro no agendador de jobs')
+        time.sleep(1)
+
+_agendador_pid = None
+_agendador_lock = threading.Lock()
+
+def iniciar_agendador():
+    """Inicia o agendador uma vez por processo"""
+    global _agendador_pid
+    with _agendador_lock:
+        if _agendador_pid == os.getpid():
+            return
+        _agendador_pid = os.getpid()
+        threading.Thread(target=_agendador, daemon=True).start()
+
+@app.before_request
+def _garantir_agendador():
+    # Após um restart, o primeiro request retoma a fila persistida
+    iniciar_agendador()
+
+# Limpeza automática
+#
+# Cada processo roda limpar_arquivos a cada LIMPEZA_INTERVALO segundos, dentro do loop
+# do agendador: saídas e uploads expiram por TTL, TEMP_FOLDER respeita TEMP_MAX_BYTES
+# (saídas mais antigas de jobs finalizados saem primeiro) e jobs finalizados deixam
+# o dicionário jobs e, após JOBS_TTL, a tabela de JOBS_DB. Arquivos de jobs na fila
+# ou em processamento nunca são removidos.
+
+# Arquivos e pastas de TEMP_FOLDER gerados por um job (output_*, partes_*, lote_*)
+_PADRAO_SAIDA_JOB = re.compile(r'^(?:output_(?:cliente_|lote_)?|partes_|lote_|cartas_)([0-9a-f]{8}(?:-[0-9a-f]{4}){3}-[0-9a-f]{12})')
+
+# Resultado da última limpeza deste processo, exibido em /debug (tamanhos das pastas também em /metrics)
+_ultima_limpeza = {}
+
+def tamanho_caminho(caminho):
+    """Tamanho de um arquivo ou, para pastas, a soma dos arquivos contidos"""
+    if os.path.isdir(caminho):
+        return tamanho_pasta(caminho)
+    try:
+        return os.path.getsize(caminho)
+    except FileNotFoundError:
+        return 0
+
+def remover_caminho(caminho):
+    """Remove um arquivo ou pasta; ignora o que outro worker já removeu"""
+    try:
+        if os.path.isdir(caminho):
+            shutil.rmtree(caminho)
+        else:
+            os.remove(caminho)
+    except FileNotFoundError:
+        pass
+
+def jobs_em_execucao():
+    """Jobs deste processo ainda não finalizados"""
+    return [job_id for job_id, job in list(jobs.items()) if job['status'] not in ('completed', 'error')]
+
+def _jobs_ativos():
+    """job_id e arquivos Excel dos jobs na fila ou em processamento"""
+    ids, uploads = set(jobs_em_execucao()), set()
+    with closing(_conexao_jobs()) as conexao:
+        for job in conexao.execute("SELECT job_id, params FROM jobs WHERE status IN ('queued', 'processing')"):
+            ids.add(job['job_id'])
+            params = json.loads(job['params'])
+            if 'excel_file' in params:
+                uploads.add(params['excel_file'])
+            for planilha in params.get('planilhas', []):
+                uploads.add(planilha['excel_file'])
+    return ids, uploads
+
+def limpar_arquivos():
+    """Aplica TTLs e a cota de TEMP_FOLDER e descarta jobs finalizados. Retorna um resumo."""
+    agora = time.time()
+    ativos, uploads_ativos = _jobs_ativos()
+    removidos = defaultdict(int)
+    bytes_removidos = defaultdict(int)
+    
+    def remover(caminho, tamanho, motivo):
+        remover_caminho(caminho)
+        removidos[motivo] += 1
+        bytes_removidos[motivo] += tamanho
+        metricas.incrementar('cartas_limpeza_removidos_total', motivo=motivo)
+        metricas.incrementar('cartas_limpeza_bytes_total', tamanho, motivo=motivo)
+    
+    # Saídas dos jobs em TEMP_FOLDER, agrupadas por job
+    saidas = defaultdict(list)
+    for nome in os.listdir(TEMP_FOLDER):
+        correspondencia = _PADRAO_SAIDA_JOB.match(nome)
+        if correspondencia and correspondencia.group(1) not in ativos:
+            caminho = os.path.join(TEMP_FOLDER, nome)
+            try:
+                mtime = os.path.getmtime(caminho)
+            except FileNotFoundError:
+                continue
+            saidas[correspondencia.group(1)].append((mtime, tamanho_caminho(caminho), caminho))
+    
+    # TTL das saídas, depois cota de TEMP_FOLDER (job com saída mais antiga primeiro)
+    ttl_saida = app.config['OUTPUT_TTL']
+    for job_id in list(saidas):
+        if ttl_saida and max(mtime for mtime, _, _ in saidas[job_id]) < agora - ttl_saida:
+            for _, tamanho, caminho in saidas.pop(job_id):
+                remover(caminho, tamanho, 'ttl_saida')
+    
+    cota = app.config['TEMP_MAX_BYTES']
+    if cota:
+        total = tamanho_pasta(TEMP_FOLDER)
+        for job_id in sorted(saidas, key=lambda j: max(mtime for mtime, _, _ in saidas[j])):
+            if total <= cota:
+                break
+            for _, tamanho, caminho in saidas[job_id]:
+                remover(caminho, tamanho, 'cota_temp')
+                total -= tamanho
+    
+    # Uploads expirados que nenhum job pendente usa
+    ttl_upload = app.config['UPLOAD_TTL']
+    if ttl_upload:
+        for nome in os.listdir(UPLOAD_FOLDER):
+            if nome in uploads_ativos:
+                continue
+            caminho = os.path.join(UPLOAD_FOLDER, nome)
+            try:
+                stat = os.stat(caminho)
+            except FileNotFoundError:
+                continue
+            if stat.st_mtime < agora - ttl_upload:
+                remover(caminho, stat.st_size, 'ttl_upload')
+    # ... e os hashes e locks memorizados dos que não existem mais
+    podar_memorias_uploads()
+    
+    # Jobs finalizados saem da memória (o estado final já está em JOBS_DB)...
+    descartados = 0
+    for job_id, job in list(jobs.items()):
+        if job['status'] in ('completed', 'error') and job.get('finalizado_em', 0) < agora - app.config['LIMPEZA_INTERVALO']:
+            jobs.pop(job_id, None)
+            descartados += 1
+    
+    # ... e de JOBS_DB depois de JOBS_TTL
+    expirados = 0
+    if app.config['JOBS_TTL']:
+        with closing(_conexao_jobs()) as conexao:
+            expirados = conexao.execute(
+                "DELETE FROM jobs WHERE status IN ('completed', 'error') AND atualizado_em < ?",
+                (agora - app.config['JOBS_TTL'],)
+            ).rowcount
+    
+    resumo = {
+        'executada_em': agora,
+        'removidos': dict(removidos),
+        'bytes_removidos': dict(bytes_removidos),
+        'jobs_descartados_da_memoria': descartados,
+        'jobs_expirados': expirados,
+        # Servidos por /metrics e /debug até a próxima limpeza
+        'pastas_bytes': {pasta: tamanho_pasta(pasta) for pasta in (UPLOAD_FOLDER, TEMP_FOLDER, CACHE_FOLDER)},
+    }
+    if removidos or expirados:
+        logger.info('Limpeza: %s', resumo)
+    _ultima_limpeza.clear()
+    _ultima_limpeza.update(resumo)
+    return resumo
 
 @app.route('/api/job-status/<job_id>')
 def job_status(job_id):
-    if job_id not in jobs:
+    job = obter_job(job_id)
+    if job is None:
         return jsonify({'error': 'Job não encontrado'}), 404
     
-    return jsonify(jobs[job_id])
+    return Response(serializar_job(job), mimetype='application/json')
+
+@app.route('/api/job-events/<job_id>')
+def job_events(job_id):
+    """
+    Progresso do job por Server-Sent Events: um evento a cada mudança de estado,
+    encerrando quando o job termina. Jobs deste processo são acordados por
+    notificar_job; jobs de outro worker são lidos de JOBS_DB a cada segundo.
+    """
+    if obter_job(job_id) is None:
+        return jsonify({'error': 'Job não encontrado'}), 404
+    
+    # Cada stream prende uma thread do gunicorn; acima do limite, o cliente usa /api/job-status
+    if _conexoes_sse[0] >= app.config['SSE_MAX_CONEXOES']:
+        response = jsonify({'error': 'Muitas conexões de progresso abertas, use /api/job-status'})
+        response.headers['Retry-After'] = '5'
+        return response, 503
+    
+    def eventos():
+        with _eventos_jobs:
+            _conexoes_sse[0] += 1
+        try:
+            ultimo = None
+            ultimo_envio = time.monotonic()
+            while True:
+                versao = _versao_eventos[0]
+                job = obter_job(job_id)
+                if job is None:
+                    return
+                dados = serializar_job(job)
+                
+                if dados != ultimo:
+                    yield f'data: {dados}\n\n'
+                    ultimo = dados
+                    ultimo_envio = time.monotonic()
+                    if job['status'] in ('completed', 'error'):
+                        return
+                elif time.monotonic() - ultimo_envio > 15:
+                    # Comentário SSE mantém a conexão viva em proxies
+                    yield ': keepalive\n\n'
+                    ultimo_envio = time.monotonic()
+                
+                with _eventos_jobs:
+                    _eventos_jobs.wait_for(lambda: _versao_eventos[0] != versao,
+                                           timeout=15 if job_id in jobs else 1)
+        finally:
+            with _eventos_jobs:
+                _conexoes_sse[0] -= 1
+    
+    response = Response(eventos(), mimetype='text/event-stream')
+    response.headers['Cache-Control'] = 'no-cache'
+    response.headers['X-Accel-Buffering'] = 'no'
+    return response
 
 @app.route('/api/download/<job_id>')
 def download_pdf(job_id):
-    if job_id not in jobs or jobs[job_id]['status'] != 'completed':
+    job = obter_job(job_id)
+    if job is None or job['status'] != 'completed':
         return jsonify({'error': 'PDF não disponível'}), 404
     
     # Tentar ambos os formatos de arquivo
     pdf_path_normal = os.path.join(TEMP_FOLDER, f'output_{job_id}.pdf')
     pdf_path_cliente = os.path.join(TEMP_FOLDER, f'output_cliente_{job_id}.pdf')
+    pdf_path_lote = os.path.join(TEMP_FOLDER, f'output_lote_{job_id}.pdf')
+    zip_path_lote = os.path.join(TEMP_FOLDER, f'output_lote_{job_id}.zip')
     
     if os.path.exists(pdf_path_normal):
         return send_file(pdf_path_normal, as_attachment=True, download_name='cartas_geradas.pdf')
     elif os.path.exists(pdf_path_cliente):
         return send_file(pdf_path_cliente, as_attachment=True, download_name='cartas_por_cliente.pdf')
+    elif os.path.exists(pdf_path_lote):
+        return send_file(pdf_path_lote, as_attachment=True, download_name='cartas_lote.pdf')
+    elif os.path.exists(zip_path_lote):
+        # send_file lê o ZIP do disco em blocos, sem carregá-lo em memória
+        return send_file(zip_path_lote, as_attachment=True, download_name='cartas_lote.zip')
     else:
         return jsonify({'error': 'Arquivo não encontrado'}), 404
 
+@app.route('/api/job-parts/<job_id>')
+def job_parts(job_id):
+    """Manifesto das partes já disponíveis de um job com entrega em partes"""
+    job = obter_job(job_id)
+    if job is None or 'partes' not in job:
+        return jsonify({'error': 'Job sem entrega em partes'}), 404
+    
+    return jsonify({
+        'job_id': job_id,
+        'status': job['status'],
+        'completo': job.get('partes_completas', False),
+        'partes': job['partes']
+    })
+
+@app.route('/api/download/<job_id>/parte/<int:numero>')
+def download_parte(job_id, numero):
+    job = obter_job(job_id)
+    if job is None or numero < 1 or numero > len(job.get('partes', [])):
+        return jsonify({'error': 'Parte não disponível'}), 404
+    
+    caminho = os.path.join(pasta_partes(job_id), f'parte_{numero:04d}.pdf')
+    if not os.path.exists(caminho):
+        return jsonify({'error': 'Arquivo não encontrado'}), 404
+    return send_file(caminho, as_attachment=True, download_name=f'cartas_parte_{numero:04d}.pdf')
+
 @app.route('/api/detect-excel-columns', methods=['POST'])
+@medir_requisicao('detect_excel_columns')
 def detect_excel_columns():
     """Detecta colunas do Excel e sugere mapeamento para cliente, número e ICCID"""
     try:
@@ -491,8 +2697,8 @@ def detect_excel_columns():
         if not os.path.exists(excel_path):
             return jsonify({'error': 'Arquivo Excel não encontrado'}), 404
         
-        # Ler dados do Excel
-        columns, data = read_excel_with_openpyxl(excel_path)
+        # Só os cabeçalhos: a sugestão não precisa das linhas
+        columns, total_linhas = ler_cabecalhos_planilha(excel_path)
         
         # Sugerir mapeamento baseado em palavras-chave
         sugestoes = {
@@ -519,13 +2725,17 @@ def detect_excel_columns():
         return jsonify({
             'excel_file': excel_file,
             'columns': columns,
-            'total_rows': len(data),
+            'total_rows': total_linhas,
             'sugestoes': sugestoes
         })
         
     except Exception as e:
         return jsonify({'error': f'Erro ao detectar colunas: {str(e)}'}), 500
 
+# Verificação de fontes na inicialização (os processos do pool não precisam dela)
+if multiprocessing.parent_process() is None:
+    verificar_fontes()
+
 if __name__ == '__main__':
     port = int(os.environ.get('PORT', 8080))
     print(f"🚀 Starting Flask app on port {port}")
@@ -540,4 +2750,7 @@ if __name__ == '__main__':
     for template in templates:
         print(f"  - {os.path.basename(template)}")
     
+    fontes = verificar_fontes()
+    print(f"🔍 Fontes: DejaVu={'✅' if fontes.get('DejaVu Sans') else '❌'} Arial={'✅' if fontes.get('Arial') else '❌'}")
+    
     app.run(host='0.0.0.0', port=port) 
\ No newline at end of file
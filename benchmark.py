@@ -0,0 +1,497 @@
+"""
+Benchmark da geração de cartas
+
+Uso:
+    python benchmark.py --cartas 1000 10000 --fontes 1000
+    python benchmark.py --pipeline --linhas 1000 10000 --json relatorio.json [--comparar base.json]
+    python benchmark.py --latencia http://localhost:8080 --cartas-job 10000 [--json latencia.json]
+
+Com --pipeline, gera planilhas sintéticas e mede cada etapa do pipeline
+Excel -> SVG -> PDF isoladamente e de ponta a ponta (tempo, cartas/s, pico de RSS
+e tamanho da saída). O job de ponta a ponta roda com a configuração atual e depois com
+o cache de cartas ativado, frio e quente. O relatório JSON pode ser comparado entre
+commits com --comparar.
+
+Com --latencia, envia uma planilha sintética a um servidor em execução, inicia um job
+e mede a latência (p50/p95/p99) de /api/job-status e /health enquanto o job renderiza
+e depois dele, com o servidor ocioso.
+"""
+import argparse
+import datetime
+import functools
+import io
+import json
+import math
+import os
+import platform
+import random
+import resource
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import urllib.error
+import urllib.request
+import uuid
+
+import openpyxl
+from cairosvg import svg2pdf
+from PyPDF2 import PdfMerger
+
+import app
+from app import carregar_template, renderizar_lote, selecionar_template
+
+def gerar_svgs(quantidade):
+    """Gera cartas sintéticas usando os templates de 1 a 6 números"""
+    svgs = []
+    for i in range(quantidade):
+        numeros_na_carta = i % 6 + 1
+        template = carregar_template(selecionar_template(numeros_na_carta))
+        numeros = [f'9{i:04d}{n:04d}' for n in range(numeros_na_carta)]
+        iccids = [f'893510{i:06d}{n:07d}' for n in range(numeros_na_carta)]
+        if numeros_na_carta == 1:
+            numeros, iccids = numeros[0], iccids[0]
+        svgs.append(template.render({
+            'CLIENTE': f'CLIENTE{i:06d}',
+            'NUMERO': numeros,
+            'ICCID': iccids,
+        }))
+    return svgs
+
+def saida_merge(svgs):
+    """Caminho anterior: um PDF por carta e mesclagem com PdfMerger"""
+    merger = PdfMerger()
+    for svg in svgs:
+        merger.append(io.BytesIO(svg2pdf(bytestring=svg.encode('utf-8'))))
+    saida = io.BytesIO()
+    merger.write(saida)
+    merger.close()
+    return saida.getvalue()
+
+def saida_superficie_unica(svgs):
+    """Caminho atual: todas as cartas numa única superfície cairo PDF"""
+    _, pdf_bytes, *_ = renderizar_lote(0, [(i, '', svg) for i, svg in enumerate(svgs)])
+    return pdf_bytes
+
+def sonda_fontes_por_carta(quantidade):
+    """Caminho anterior: fc-list executado antes de cada carta"""
+    for _ in range(quantidade):
+        try:
+            result = subprocess.run(['fc-list'], capture_output=True, text=True, timeout=10)
+            'Arial' in result.stdout
+        except Exception:
+            pass
+
+def sonda_fontes_em_cache(quantidade):
+    """Caminho atual: verificação única, reaproveitada por todas as cartas"""
+    app._fontes = None
+    for _ in range(quantidade):
+        app.verificar_fontes()
+
+def medir_fontes(quantidade):
+    print(f"🔍 Verificação de fontes para {quantidade} cartas")
+    for nome, funcao in (('fc-list/carta', sonda_fontes_por_carta), ('cache', sonda_fontes_em_cache)):
+        inicio = time.perf_counter()
+        funcao(quantidade)
+        duracao = time.perf_counter() - inicio
+        print(f"  {nome:<16} {duracao:8.2f}s  {duracao / quantidade * 1000:8.3f} ms/carta")
+
+def medir(nome, funcao, svgs):
+    inicio = time.perf_counter()
+    pdf_bytes = funcao(svgs)
+    duracao = time.perf_counter() - inicio
+    print(f"  {nome:<16} {duracao:8.2f}s  {len(svgs) / duracao:8.1f} cartas/s  {len(pdf_bytes) / 1024:10.0f} KB")
+
+# Pipeline completo com planilhas sintéticas
+
+COLUNAS = ('Cliente', 'Número', 'ICCID')
+
+def gerar_planilha(caminho, linhas, tamanhos, seed=1, prefixo='CLIENTE'):
+    """
+    Grava uma planilha sintética com `linhas` linhas. Cada cliente recebe uma quantidade
+    de números sorteada de `tamanhos` (1 a 6 cobrem os seis templates; acima de 6 a
+    carta é dividida). As linhas são embaralhadas para que os clientes venham
+    intercalados, como nas exportações reais. Retorna a quantidade de clientes.
+    """
+    aleatorio = random.Random(seed)
+    registros = []
+    cliente = 0
+    while len(registros) < linhas:
+        quantidade = min(aleatorio.choice(tamanhos), linhas - len(registros))
+        for _ in range(quantidade):
+            i = len(registros)
+            registros.append((f'{prefixo} {cliente:06d}', f'119{i:08d}', f'8955{i:015d}'))
+        cliente += 1
+    aleatorio.shuffle(registros)
+
+    workbook = openpyxl.Workbook(write_only=True)
+    sheet = workbook.create_sheet()
+    sheet.append(COLUNAS)
+    for registro in registros:
+        sheet.append(registro)
+    workbook.save(caminho)
+    return cliente
+
+def pico_rss_kb():
+    """
+    Pico de RSS (KB) deste processo e a soma dos picos dos workers vivos dos dois pools:
+    renderização e CPU (leitura do Excel, validação e montagem dos PDFs)
+    """
+    workers = 0
+    pids = []
+    for executor in (app._executor_render, app._executor_cpu):
+        pids.extend(getattr(executor, '_processes', None) or {})
+    for pid in pids:
+        try:
+            with open(f'/proc/{pid}/status') as f:
+                for linha in f:
+                    if linha.startswith('VmHWM:'):
+                        workers += int(linha.split()[1])
+        except OSError:
+            pass  # fora do Linux ou worker já encerrado
+    return {'principal': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss, 'workers': workers}
+
+def mesclar_pdfs(pdfs):
+    """Mescla os PDFs (bytes) dos lotes no pool de CPU, como o job faz no final; retorna o tamanho"""
+    output_path = os.path.join(app.TEMP_FOLDER, f'benchmark_mesclagem_{uuid.uuid4().hex[:8]}.pdf')
+    try:
+        app.executar_no_pool_cpu(app.gravar_paginas_pdf, pdfs, None, output_path)
+        return os.path.getsize(output_path)
+    finally:
+        if os.path.exists(output_path):
+            os.remove(output_path)
+
+def cronometrar(etapas, nome, funcao, cartas=None):
+    """Executa funcao(), registra a etapa em `etapas` e devolve o resultado"""
+    inicio = time.perf_counter()
+    resultado = funcao()
+    duracao = time.perf_counter() - inicio
+    etapas[nome] = {'segundos': round(duracao, 4), 'pico_rss_kb': pico_rss_kb()}
+    if cartas:
+        etapas[nome]['cartas_por_segundo'] = round(cartas / duracao, 1)
+    print(f"  {nome:<28} {duracao:8.3f}s" + (f"  {cartas / duracao:8.1f} cartas/s" if cartas else ''))
+    return resultado
+
+def medir_pipeline(linhas, tamanhos, empacotar=False):
+    """Mede as etapas isoladas e o job de ponta a ponta sobre uma planilha sintética"""
+    execucao = uuid.uuid4().hex[:8]
+    excel_file = f'benchmark_{linhas}_{execucao}.xlsx'
+    excel_path = os.path.join(app.UPLOAD_FOLDER, excel_file)
+    # O prefixo único garante que a primeira execução com o cache de cartas parte do cache frio
+    clientes_gerados = gerar_planilha(excel_path, linhas, tamanhos, prefixo=f'CLIENTE {execucao}')
+    print(f"📊 {linhas} linhas, {clientes_gerados} clientes")
+    carga = {'nome': f'linhas_{linhas}', 'linhas': linhas, 'clientes': clientes_gerados,
+             'tamanhos': tamanhos, 'xlsx_bytes': os.path.getsize(excel_path), 'etapas': {}}
+    etapas = carga['etapas']
+    coluna_cliente, coluna_numero, coluna_iccid = COLUNAS
+    cache_path = app._caminho_cache_planilha(app.hash_arquivo(excel_path))
+    max_por_carta = app.numeros_por_carta(empacotar)
+
+    try:
+        cronometrar(etapas, 'leitura_openpyxl', lambda: app.read_excel_with_openpyxl(excel_path))
+        if os.path.exists(cache_path):
+            os.remove(cache_path)
+        cronometrar(etapas, 'leitura_colunar_fria', lambda: app.ler_colunas_planilha(excel_path, COLUNAS))
+        _, colunas = cronometrar(etapas, 'leitura_colunar_cache', lambda: app.ler_colunas_planilha(excel_path, COLUNAS))
+
+        clientes = cronometrar(etapas, 'agrupamento',
+                               lambda: app.agrupar_por_cliente(app.linhas_de_colunas(colunas), coluna_cliente))
+        cartas_por_quantidade = cronometrar(etapas, 'contagem',
+                                            lambda: app.contar_cartas(clientes, coluna_numero, coluna_iccid, max_por_carta))
+        total = app.total_de_cartas(cartas_por_quantidade)
+        carga['cartas'] = total
+        carga['cartas_por_template'] = {selecionar_template(q): n for q, n in cartas_por_quantidade.items()}
+
+        cartas = cronometrar(etapas, 'substituicao', lambda: [
+            (indice, cliente_nome, svg) for indice, (cliente_nome, _, _, svg)
+            in enumerate(app.gerar_cartas(clientes, coluna_numero, coluna_iccid, max_por_carta=max_por_carta))
+        ], total)
+
+        lotes = list(enumerate(app.agrupar_em_lotes(cartas, app.app.config['CARTAS_POR_LOTE'])))
+        cronometrar(etapas, 'renderizacao_1_lote', lambda: renderizar_lote(*lotes[0]), len(lotes[0][1]))
+        pdfs = cronometrar(etapas, 'renderizacao_pool',
+                           lambda: [r[1] for r in app.renderizar_em_paralelo(renderizar_lote, lotes)], total)
+        carga['pdf_bytes'] = cronometrar(etapas, 'mesclagem', functools.partial(mesclar_pdfs, pdfs), total)
+        del cartas, pdfs
+
+        # Ponta a ponta: o job real, com a configuração atual (por padrão sem o cache de cartas)
+        cartas_antes = set(os.listdir(app.CACHE_FOLDER))
+        render_cache = app.app.config['RENDER_CACHE_MAX_BYTES']
+        try:
+            medir_job(etapas, 'ponta_a_ponta', excel_file, empacotar, total)
+
+            # Com o cache de cartas, partindo do cache frio: a primeira execução separa as
+            # páginas e grava o cache, a repetição monta o PDF com as cartas do cache
+            remover_cartas_novas(cartas_antes)
+            app.app.config['RENDER_CACHE_MAX_BYTES'] = render_cache or 512 * 1024 * 1024
+            medir_job(etapas, 'ponta_a_ponta_cache_frio', excel_file, empacotar, total)
+            medir_job(etapas, 'ponta_a_ponta_cache_quente', excel_file, empacotar, total)
+        finally:
+            app.app.config['RENDER_CACHE_MAX_BYTES'] = render_cache
+            remover_cartas_novas(cartas_antes)
+    finally:
+        for caminho in (excel_path, cache_path):
+            if os.path.exists(caminho):
+                os.remove(caminho)
+    return carga
+
+def remover_cartas_novas(cartas_antes):
+    """Remove do cache as cartas gravadas pelo benchmark"""
+    for nome in set(os.listdir(app.CACHE_FOLDER)) - cartas_antes:
+        if nome.startswith('carta_'):
+            os.remove(os.path.join(app.CACHE_FOLDER, nome))
+
+def medir_job(etapas, nome, excel_file, empacotar, cartas):
+    """Executa o job por cliente como o servidor faz e registra tempo, tempos do job e tamanho do PDF"""
+    job_id = str(uuid.uuid4())
+    coluna_cliente, coluna_numero, coluna_iccid = COLUNAS
+    cronometrar(etapas, nome, lambda: app.process_pdf_generation_por_cliente(
+        job_id, excel_file, coluna_cliente, coluna_numero, coluna_iccid, empacotar=empacotar), cartas)
+    job = app.jobs.pop(job_id)
+    if job['status'] != 'completed':
+        raise RuntimeError(f"Job do benchmark falhou: {job['message']}")
+    output_path = os.path.join(app.TEMP_FOLDER, f'output_cliente_{job_id}.pdf')
+    etapas[nome]['tempos_job'] = job['tempos']
+    etapas[nome]['pdf_bytes'] = os.path.getsize(output_path)
+    os.remove(output_path)
+
+def commit_atual():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True,
+                              text=True, timeout=10).stdout.strip() or None
+    except Exception:
+        return None
+
+def comparar(relatorio, caminho_base):
+    """Imprime a variação de tempo de cada etapa em relação a um relatório anterior"""
+    with open(caminho_base) as f:
+        base = json.load(f)
+    cargas_base = {carga['nome']: carga for carga in base['cargas']}
+    print(f"🔁 Comparação com {caminho_base} (commit {base.get('commit')})")
+    for carga in relatorio['cargas']:
+        anterior = cargas_base.get(carga['nome'])
+        if anterior is None:
+            continue
+        print(f"  {carga['nome']}")
+        for etapa, medida in carga['etapas'].items():
+            if etapa not in anterior['etapas']:
+                continue
+            antes = anterior['etapas'][etapa]['segundos']
+            depois = medida['segundos']
+            variacao = (depois - antes) / antes * 100 if antes else 0
+            print(f"    {etapa:<28} {antes:8.3f}s -> {depois:8.3f}s  {variacao:+6.1f}%")
+
+def executar_pipeline(args):
+    tamanhos = [int(t) for t in args.tamanhos.split(',')]
+    # A fila de jobs do benchmark não se mistura com a da aplicação
+    app.app.config['JOBS_DB'] = os.path.join(tempfile.mkdtemp(prefix='benchmark_'), 'jobs.db')
+    # A leitura do Excel roda no pool de CPU: iniciá-lo antes para não medir o spawn
+    app.executar_no_pool_cpu(os.getpid)
+
+    relatorio = {
+        'commit': commit_atual(),
+        'data': datetime.datetime.now().isoformat(timespec='seconds'),
+        'python': sys.version.split()[0],
+        'plataforma': platform.platform(),
+        'config': {chave: app.app.config[chave] for chave in ('MAX_WORKERS', 'CARTAS_POR_LOTE', 'PDF_SPILL_BYTES',
+                                                              'RENDER_CACHE_MAX_BYTES')},
+        'empacotar': args.empacotar,
+        'cargas': [medir_pipeline(linhas, tamanhos, args.empacotar) for linhas in args.linhas],
+    }
+
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(relatorio, f, indent=2, ensure_ascii=False)
+        print(f"💾 Relatório salvo em {args.json}")
+    if args.comparar:
+        comparar(relatorio, args.comparar)
+
+def requisitar(url, dados=None, metodo=None, corpo=None, headers=None, timeout=30):
+    """Requisição HTTP com a biblioteca padrão; `dados` vai como JSON e a resposta volta decodificada"""
+    headers = dict(headers or {})
+    if dados is not None:
+        corpo = json.dumps(dados).encode('utf-8')
+        headers['Content-Type'] = 'application/json'
+    pedido = urllib.request.Request(url, data=corpo, method=metodo, headers=headers)
+    with urllib.request.urlopen(pedido, timeout=timeout) as resposta:
+        return json.loads(resposta.read() or b'null')
+
+def enviar_planilha(url, caminho):
+    """Envia a planilha pelo upload em partes e devolve o nome no servidor"""
+    tamanho = os.path.getsize(caminho)
+    upload = requisitar(f'{url}/api/upload-excel/iniciar',
+                        {'filename': os.path.basename(caminho), 'tamanho': tamanho})
+    with open(caminho, 'rb') as f:
+        inicio = 0
+        while inicio < tamanho:
+            parte = f.read(upload['tamanho_parte'])
+            fim = inicio + len(parte) - 1
+            resposta = requisitar(f"{url}/api/upload-excel/{upload['upload_id']}", metodo='PUT', corpo=parte,
+                                  headers={'Content-Range': f'bytes {inicio}-{fim}/{tamanho}',
+                                           'Content-Type': 'application/octet-stream'})
+            inicio = fim + 1
+    return resposta['filename']
+
+def percentis(latencias_ms, erros):
+    """p50/p95/p99 e máximo (ms) pelo método do posto mais próximo"""
+    if not latencias_ms:
+        return {'requisicoes': 0, 'erros': erros}
+    ordenadas = sorted(latencias_ms)
+    def percentil(q):
+        return round(ordenadas[max(0, math.ceil(len(ordenadas) * q / 100) - 1)], 1)
+    return {'requisicoes': len(ordenadas), 'erros': erros, 'p50_ms': percentil(50),
+            'p95_ms': percentil(95), 'p99_ms': percentil(99), 'max_ms': round(ordenadas[-1], 1)}
+
+def amostrar_latencias(urls, parar, clientes, intervalo, timeout):
+    """
+    `clientes` threads alternam entre as URLs até `parar` ser sinalizado. Requisições
+    que falham ou estouram o timeout contam como erro (e com a latência até a falha).
+    """
+    amostras = {nome: [] for nome in urls}
+    erros = {nome: 0 for nome in urls}
+    trava = threading.Lock()
+
+    def cliente(deslocamento):
+        nomes = list(urls)
+        i = deslocamento
+        while not parar.is_set():
+            nome = nomes[i % len(nomes)]
+            i += 1
+            inicio = time.perf_counter()
+            try:
+                with urllib.request.urlopen(urls[nome], timeout=timeout) as resposta:
+                    resposta.read()
+                falhou = False
+            except (urllib.error.URLError, OSError):
+                falhou = True
+            duracao_ms = (time.perf_counter() - inicio) * 1000
+            with trava:
+                amostras[nome].append(duracao_ms)
+                erros[nome] += falhou
+            parar.wait(intervalo)
+
+    threads = [threading.Thread(target=cliente, args=(i,), daemon=True) for i in range(clientes)]
+    for thread in threads:
+        thread.start()
+    return threads, lambda: {nome: percentis(amostras[nome], erros[nome]) for nome in urls}
+
+def imprimir_latencias(fase, resultado):
+    print(f"  {fase}")
+    for nome, medida in resultado.items():
+        if not medida['requisicoes']:
+            continue
+        print(f"    {nome:<12} {medida['requisicoes']:6d} req  p50 {medida['p50_ms']:7.1f}ms  "
+              f"p95 {medida['p95_ms']:7.1f}ms  p99 {medida['p99_ms']:7.1f}ms  "
+              f"max {medida['max_ms']:7.1f}ms  erros {medida['erros']}")
+
+def executar_latencia(args):
+    url = args.latencia.rstrip('/')
+    execucao = uuid.uuid4().hex[:8]
+    pasta = tempfile.mkdtemp(prefix='benchmark_')
+    caminho = os.path.join(pasta, f'carga_{args.cartas_job}_{execucao}.xlsx')
+    # Um número por cliente: uma carta por linha. O prefixo único evita o cache de cartas do servidor
+    gerar_planilha(caminho, args.cartas_job, [1], prefixo=f'CARGA {execucao}')
+    try:
+        excel_file = enviar_planilha(url, caminho)
+    finally:
+        os.remove(caminho)
+        os.rmdir(pasta)
+    print(f"📤 {excel_file} enviado ({args.cartas_job} cartas)")
+
+    job = requisitar(f'{url}/api/generate-pdfs-por-cliente', {
+        'excel_file': excel_file,
+        'coluna_cliente': COLUNAS[0], 'coluna_numero': COLUNAS[1], 'coluna_iccid': COLUNAS[2],
+        'prioridade': 10,
+    })
+    job_id = job['job_id']
+    urls = {'job_status': f'{url}/api/job-status/{job_id}', 'health': f'{url}/health'}
+    relatorio = {'commit': commit_atual(), 'data': datetime.datetime.now().isoformat(timespec='seconds'),
+                 'url': url, 'cartas': args.cartas_job, 'clientes_http': args.clientes, 'job_id': job_id}
+
+    # Durante o job: amostrar até o job terminar
+    parar = threading.Event()
+    inicio = time.perf_counter()
+    threads, resumo = amostrar_latencias(urls, parar, args.clientes, args.intervalo, args.timeout)
+    try:
+        while True:
+            estado = requisitar(urls['job_status'], timeout=args.timeout)
+            if estado['status'] in ('completed', 'error'):
+                break
+            time.sleep(0.5)
+    finally:
+        parar.set()
+        for thread in threads:
+            thread.join()
+    relatorio['job'] = {'status': estado['status'], 'mensagem': estado['message'],
+                        'segundos': round(time.perf_counter() - inicio, 2), 'tempos': estado.get('tempos')}
+    relatorio['durante_job'] = resumo()
+
+    # Depois do job: a mesma carga com o servidor ocioso, como referência
+    parar = threading.Event()
+    threads, resumo = amostrar_latencias(urls, parar, args.clientes, args.intervalo, args.timeout)
+    time.sleep(args.ocioso)
+    parar.set()
+    for thread in threads:
+        thread.join()
+    relatorio['ocioso'] = resumo()
+
+    print(f"📊 Job {estado['status']} em {relatorio['job']['segundos']}s: {estado['message']}")
+    imprimir_latencias('durante o job', relatorio['durante_job'])
+    imprimir_latencias('servidor ocioso', relatorio['ocioso'])
+
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(relatorio, f, indent=2, ensure_ascii=False)
+        print(f"💾 Relatório salvo em {args.json}")
+    if estado['status'] != 'completed':
+        sys.exit(1)
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark da geração de cartas')
+    parser.add_argument('--cartas', type=int, nargs='+', default=[1000, 10000],
+                        help='quantidades de cartas a medir')
+    parser.add_argument('--fontes', type=int, default=1000,
+                        help='cartas simuladas na medição da verificação de fontes (0 desativa)')
+    parser.add_argument('--pipeline', action='store_true',
+                        help='mede o pipeline completo com planilhas sintéticas')
+    parser.add_argument('--linhas', type=int, nargs='+', default=[1000, 10000],
+                        help='linhas das planilhas sintéticas (com --pipeline)')
+    parser.add_argument('--tamanhos', default='1,2,3,4,5,6,8,13',
+                        help='números por cliente sorteados nas planilhas sintéticas (com --pipeline)')
+    parser.add_argument('--empacotar', action='store_true',
+                        help='usa o modo de empacotamento (templates de 12/24 números) no pipeline')
+    parser.add_argument('--latencia', metavar='URL',
+                        help='mede a latência de /api/job-status num servidor em execução durante um job')
+    parser.add_argument('--cartas-job', type=int, default=10000,
+                        help='cartas do job gerado durante a medição de latência (com --latencia)')
+    parser.add_argument('--clientes', type=int, default=8,
+                        help='clientes HTTP simultâneos (com --latencia)')
+    parser.add_argument('--intervalo', type=float, default=0.05,
+                        help='pausa de cada cliente entre requisições, em segundos (com --latencia)')
+    parser.add_argument('--timeout', type=float, default=10,
+                        help='timeout de cada requisição, em segundos (com --latencia)')
+    parser.add_argument('--ocioso', type=float, default=5,
+                        help='segundos de medição com o servidor ocioso após o job (com --latencia)')
+    parser.add_argument('--json', help='grava o relatório do pipeline ou da latência neste arquivo')
+    parser.add_argument('--comparar', help='relatório JSON anterior para comparar com o atual')
+    args = parser.parse_args()
+
+    if args.pipeline:
+        executar_pipeline(args)
+        return
+    if args.latencia:
+        executar_latencia(args)
+        return
+
+    if args.fontes:
+        medir_fontes(args.fontes)
+
+    for quantidade in args.cartas:
+        print(f"📊 {quantidade} cartas")
+        svgs = gerar_svgs(quantidade)
+        medir('merge', saida_merge, svgs)
+        medir('superficie_unica', saida_superficie_unica, svgs)
+
+if __name__ == '__main__':
+    main()
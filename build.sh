@@ -28,6 +28,7 @@ pip install --no-cache-dir --constraint constraints.txt Flask==3.0.0
 pip install --no-cache-dir --constraint constraints.txt Werkzeug==3.0.1
 pip install --no-cache-dir --constraint constraints.txt openpyxl==3.1.2
 pip install --no-cache-dir --constraint constraints.txt cairosvg==2.8.0
+pip install --no-cache-dir --constraint constraints.txt cairocffi==1.7.1
 pip install --no-cache-dir --constraint constraints.txt PyPDF2==3.0.1
 pip install --no-cache-dir --constraint constraints.txt gunicorn==21.2.0
 
@@ -16,5 +16,7 @@ echo "🌐 Iniciando gunicorn na porta $PORT..."
 exec gunicorn app:app \
     --bind 0.0.0.0:$PORT \
     --workers 1 \
+    --worker-class gthread \
+    --threads 8 \
     --timeout 120 \
     --log-level info 
\ No newline at end of file